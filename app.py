@@ -1,13 +1,21 @@
 import streamlit as st
 import pandas as pd
-import gspread
-from google.oauth2.service_account import Credentials
-from docxtpl import DocxTemplate
+import numpy as np
 from io import BytesIO
 import openpyxl
 import datetime
-import requests 
-import google.generativeai as genai 
+import time
+from pricing import (
+    DEFAULT_CLIENT_SUMMARY, NEAREST_GEOCODE_MAX_CALLS, NEAREST_GEOCODE_MAX_SECONDS,
+    CallBudget, LogStore, ServiceUnavailable, ExternalCallFailed,
+    get_gspread_client, load_data, load_rates, load_distance_cache,
+    load_client_summary_cache, load_terms, load_geocode_cache,
+    get_log_sheet, get_log_store, log_requests,
+    save_to_distance_cache, save_rows_to_distance_cache, save_to_client_summary_cache, save_to_geocode_cache,
+    get_circuit_breakers, configure_gemini, get_ai_client_summary, get_driving_distance,
+    price_batch, find_nearest_priced_lanes, render_quote_docx
+)
+from pricing_api import start_in_background as start_pricing_api
 
 # --- 1. SET UP PAGE CONFIGURATION ---
 st.set_page_config(
@@ -16,255 +24,6 @@ st.set_page_config(
     layout="wide"
 )
 
-# --- 2. GOOGLE SHEETS CONNECTION ---
-@st.cache_resource
-def get_gspread_client():
-    scopes = [
-        'https://www.googleapis.com/auth/spreadsheets',
-        'https://www.googleapis.com/auth/drive'
-    ]
-    creds = Credentials.from_service_account_info(
-        st.secrets["google_credentials"], scopes=scopes
-    )
-    client = gspread.authorize(creds)
-    return client
-
-# --- 3. LOAD DATA FUNCTIONS (WITH NEW CLEANING) ---
-@st.cache_data(ttl=600)
-def load_data(_client):
-    try:
-        sheet_name = "price_list"
-        spreadsheet = _client.open(sheet_name)
-        worksheet = spreadsheet.worksheet("Sheet1") # Your price list tab
-        
-        data = worksheet.get_all_records()
-        df = pd.DataFrame(data)
-        
-        if df.empty:
-            return pd.DataFrame()
-            
-        for col in df.select_dtypes(include=['object']).columns:
-            df[col] = df[col].astype(str).str.strip()
-        df.columns = df.columns.str.strip() # Clean headers too
-        
-        if 'Price' in df.columns:
-            df['Price'] = pd.to_numeric(df['Price'], errors='coerce')
-        return df
-    except Exception as e:
-        st.error(f"An error occurred while loading price_list data: {e}")
-        return pd.DataFrame()
-
-@st.cache_data(ttl=600)
-def load_rates(_client):
-    try:
-        sheet_name = "price_list"
-        spreadsheet = _client.open(sheet_name)
-        worksheet = spreadsheet.worksheet("rate_list") # Your new rate card tab
-        
-        data = worksheet.get_all_records()
-        df = pd.DataFrame(data)
-        
-        if df.empty:
-            return pd.DataFrame(columns=['Truck_Type', 'Rate_per_KM', 'Currency'])
-            
-        for col in df.select_dtypes(include=['object']).columns:
-            df[col] = df[col].astype(str).str.strip()
-        df.columns = df.columns.str.strip() # Clean headers too
-        
-        if 'Rate_per_KM' in df.columns:
-            df['Rate_per_KM'] = pd.to_numeric(df['Rate_per_KM'], errors='coerce')
-        return df
-    except gspread.exceptions.WorksheetNotFound:
-        st.error("Error: 'rate_list' tab not found in your Google Sheet. Estimation is disabled.")
-        return pd.DataFrame(columns=['Truck_Type', 'Rate_per_KM', 'Currency'])
-    except Exception as e:
-        st.error(f"An error occurred while loading rate_list data: {e}")
-        return pd.DataFrame(columns=['Truck_Type', 'Rate_per_KM', 'Currency'])
-
-@st.cache_data(ttl=600)
-def load_distance_cache(_client):
-    try:
-        sheet_name = "price_list"
-        spreadsheet = _client.open(sheet_name)
-        worksheet = spreadsheet.worksheet("distance_cache") # Your new cache tab
-        
-        data = worksheet.get_all_records()
-        df = pd.DataFrame(data)
-        
-        if df.empty:
-            df = pd.DataFrame(columns=['From_Country', 'From_City', 'To_Country', 'To_City', 'Distance_KM'])
-        
-        df.columns = df.columns.str.strip()
-        
-        if 'Distance_KM' in df.columns:
-            df['Distance_KM'] = pd.to_numeric(df['Distance_KM'], errors='coerce')
-        return df
-    except gspread.exceptions.WorksheetNotFound:
-        st.error("Error: 'distance_cache' tab not found in your Google Sheet. Cache is disabled.")
-        return pd.DataFrame(columns=['From_Country', 'From_City', 'To_Country', 'To_City', 'Distance_KM'])
-    except Exception as e:
-        st.error(f"An error occurred while loading distance_cache data: {e}")
-        return pd.DataFrame(columns=['From_Country', 'From_City', 'To_Country', 'To_City', 'Distance_KM'])
-
-@st.cache_data(ttl=600)
-def load_client_summary_cache(_client):
-    try:
-        sheet_name = "price_list"
-        spreadsheet = _client.open(sheet_name)
-        worksheet = spreadsheet.worksheet("client_summary_cache") # Your new cache tab
-        
-        data = worksheet.get_all_records()
-        df = pd.DataFrame(data)
-        
-        if df.empty:
-            df = pd.DataFrame(columns=['Client_Company_Name', 'Summary_Text'])
-        
-        df.columns = df.columns.str.strip()
-        
-        return df
-    except gspread.exceptions.WorksheetNotFound:
-        st.error("Error: 'client_summary_cache' tab not found in your Google Sheet. AI Cache is disabled.")
-        return pd.DataFrame(columns=['Client_Company_Name', 'Summary_Text'])
-    except Exception as e:
-        st.error(f"An error occurred while loading client_summary_cache data: {e}")
-        return pd.DataFrame(columns=['Client_Company_Name', 'Summary_Text'])
-
-# --- THIS IS NEW: LOAD T&Cs ---
-@st.cache_data(ttl=600)
-def load_terms(_client):
-    try:
-        sheet_name = "price_list"
-        spreadsheet = _client.open(sheet_name)
-        worksheet = spreadsheet.worksheet("terms_list") # Your new T&C tab
-        
-        data = worksheet.get_all_records()
-        df = pd.DataFrame(data)
-        
-        if df.empty:
-            df = pd.DataFrame(columns=['From_Country', 'To_Country', 'Terms_Text'])
-        
-        for col in df.select_dtypes(include=['object']).columns:
-            df[col] = df[col].astype(str).str.strip()
-        df.columns = df.columns.str.strip()
-        
-        return df
-    except gspread.exceptions.WorksheetNotFound:
-        st.error("Error: 'terms_list' tab not found in your Google Sheet. Default T&Cs will be used.")
-        return pd.DataFrame(columns=['From_Country', 'To_Country', 'Terms_Text'])
-    except Exception as e:
-        st.error(f"An error occurred while loading T&Cs data: {e}")
-        return pd.DataFrame(columns=['From_Country', 'To_Country', 'Terms_Text'])
-
-# --- 4. FUNCTION TO GET LOG SHEET ---
-@st.cache_resource
-def get_log_sheet(_client):
-    try:
-        spreadsheet = _client.open("price_list")
-        log_sheet = spreadsheet.worksheet("request_log")
-        return log_sheet
-    except Exception as e:
-        st.error(f"Error connecting to log sheet: {e}")
-        return None
-
-# --- 5. CACHE-SAVING FUNCTIONS ---
-def save_to_distance_cache(client, row_data):
-    try:
-        spreadsheet = client.open("price_list")
-        cache_sheet = spreadsheet.worksheet("distance_cache")
-        cache_sheet.append_row(row_data)
-        load_distance_cache.clear()
-    except Exception as e:
-        st.warning(f"Failed to save to distance cache: {e}")
-
-def save_to_client_summary_cache(client, row_data):
-    try:
-        spreadsheet = client.open("price_list")
-        cache_sheet = spreadsheet.worksheet("client_summary_cache")
-        cache_sheet.append_row(row_data)
-        load_client_summary_cache.clear()
-    except Exception as e:
-        st.warning(f"Failed to save to AI summary cache: {e}")
-
-# --- 6. AI & ESTIMATION FUNCTIONS ---
-def configure_gemini(api_key):
-    genai.configure(api_key=api_key)
-    model = genai.GenerativeModel('models/gemini-flash-latest') 
-    return model
-
-@st.cache_data(ttl=3600)
-def get_ai_client_summary(_model, company_name):
-    if not company_name:
-        return "Client details as provided by user."
-    try:
-        prompt = f"Briefly summarize the company '{company_name}' in 2-3 professional lines, focusing on their industry."
-        response = _model.generate_content(prompt)
-        return response.text
-    except Exception as e:
-        st.warning(f"AI client summary failed: {e}")
-        return "Client details as provided by user."
-
-COUNTRY_MAP = {
-    "UAE": "United Arab Emirates",
-    "KSA": "Saudi Arabia",
-    "Oman": "Oman",
-    "Bahrain": "Bahrain",
-    "Jordan": "Jordan",
-    "Egypt": "Egypt",
-    "Qatar": "Qatar",
-    "Kuwait": "Kuwait"
-}
-
-@st.cache_data(ttl=3600)
-def get_driving_distance(from_city, from_country, to_city, to_country, api_key):
-    try:
-        geocode_base_url = "https://api.geoapify.com/v1/geocode/search"
-        
-        full_from_country = COUNTRY_MAP.get(from_country, from_country)
-        full_to_country = COUNTRY_MAP.get(to_country, to_country)
-        
-        geocode_params_from = {
-            "text": f"{from_city}, {full_from_country}",
-            "apiKey": api_key
-        }
-        resp_from = requests.get(geocode_base_url, params=geocode_params_from)
-        resp_from.raise_for_status()
-        data_from = resp_from.json()
-
-        geocode_params_to = {
-            "text": f"{to_city}, {full_to_country}",
-            "apiKey": api_key
-        }
-        resp_to = requests.get(geocode_base_url, params=geocode_params_to)
-        resp_to.raise_for_status()
-        data_to = resp_to.json()
-        
-        if not data_from.get("features") or not data_to.get("features"):
-            st.error("Could not find coordinates for one or more cities. Check spelling.")
-            return None
-
-        from_lon, from_lat = data_from["features"][0]["geometry"]["coordinates"]
-        to_lon, to_lat = data_to["features"][0]["geometry"]["coordinates"]
-
-        routing_base_url = "https://api.geoapify.com/v1/routing"
-        routing_params = {
-            "waypoints": f"{from_lat},{from_lon}|{to_lat},{to_lon}",
-            "mode": "drive", "format": "json", "apiKey": api_key
-        }
-        resp_matrix = requests.get(routing_base_url, params=routing_params)
-        resp_matrix.raise_for_status()
-        data_matrix = resp_matrix.json()
-
-        results = data_matrix.get("results")
-        if not results: return None
-        route = results[0]
-        distance_meters = route.get("distance")
-        if distance_meters is None: return None
-        distance_km = distance_meters / 1000
-        return round(distance_km, 2)
-    except Exception as e:
-        st.error(f"Error during geocoding: {e}")
-        return None
-
 # Load all data
 client = get_gspread_client()
 df = load_data(client)
@@ -272,7 +31,15 @@ rates_df = load_rates(client)
 distance_cache_df = load_distance_cache(client) 
 client_summary_cache_df = load_client_summary_cache(client)
 terms_df = load_terms(client) # <-- NEW
-log_sheet = get_log_sheet(client)
+geocode_cache_df = load_geocode_cache(client)
+log_sheet = get_log_sheet(client, datetime.date.today().strftime("%Y_%m"))
+
+# Optional: serve the pricing HTTP API from this process so it shares the warm caches
+if st.secrets.get("pricing_api_port"):
+    try:
+        start_pricing_api(st.secrets.get("pricing_api_host", "127.0.0.1"), int(st.secrets["pricing_api_port"]))
+    except OSError as e:
+        st.warning(f"Pricing API could not start: {e}")
 
 # --- THIS IS THE FIX: A new callback function ---
 def update_terms():
@@ -303,7 +70,7 @@ def update_terms():
 st.title("🚚 TruKKer Internal Quoting Tool")
 st.markdown("---")
 
-tab1, tab2 = st.tabs(["Single Lane Quote", "Batch Excel Upload"])
+tab1, tab2, tab3 = st.tabs(["Single Lane Quote", "Batch Excel Upload", "Analytics"])
 
 # --- THIS IS THE FIX: Initialize Session State for T&Cs ---
 if 'single_terms' not in st.session_state:
@@ -413,7 +180,7 @@ with tab1:
                 st.warning("Please fill in all details (Client, Lane, and Prepared by).")
             else:
                 gemini_api_key = st.secrets.get("gemini_api_key")
-                client_company_summary = "Client details as provided by user." 
+                client_company_summary = DEFAULT_CLIENT_SUMMARY
                 
                 if gemini_api_key and req_client_company_name:
                     cache_result = client_summary_cache_df[
@@ -428,9 +195,10 @@ with tab1:
                         ai_model = configure_gemini(gemini_api_key)
                         with st.spinner("Generating AI Client Summary..."):
                             client_company_summary = get_ai_client_summary(ai_model, req_client_company_name)
-                            cache_data = [req_client_company_name, client_company_summary]
-                            save_to_client_summary_cache(client, cache_data)
-                            st.success("New summary saved to cache.")
+                            if client_company_summary != DEFAULT_CLIENT_SUMMARY:
+                                cache_data = [req_client_company_name, client_company_summary]
+                                save_to_client_summary_cache(client, cache_data)
+                                st.success("New summary saved to cache.")
                             
                 elif gemini_api_key and not req_client_company_name:
                     st.info("No company name entered, skipping AI summary.")
@@ -464,13 +232,10 @@ with tab1:
                     st.success(f"**Exact Price Found!**")
                     st.metric(label="Calculated Price", value=f"{matched_price} {req_currency}")
                     
-                    if log_sheet:
-                        log_data.extend(["Price Found", float(matched_price), req_currency])
-                        try: log_sheet.append_row(log_data); st.info("Request logged.")
-                        except Exception as e: st.warning(f"Failed to log request: {e}")
+                    log_data.extend(["Price Found", float(matched_price), req_currency])
+                    if log_requests(log_sheet, [log_data]): st.info("Request logged.")
                     
                     try:
-                        doc = DocxTemplate("quote_template.docx")
                         context = {
                             'client_company_summary': client_company_summary, 
                             'scope_summary': req_scope_summary,          
@@ -481,12 +246,9 @@ with tab1:
                             'price': f"{matched_price:,.2f}", 
                             'terms_and_conditions': final_terms # <-- Use the final edited text
                         }
-                        doc.render(context)
-                        file_stream = BytesIO()
-                        doc.save(file_stream)
-                        file_stream.seek(0)
+                        quote_bytes = render_quote_docx(context)
                         st.download_button(
-                            label="⬇️ Download Quote as .docx", data=file_stream,
+                            label="⬇️ Download Quote as .docx", data=quote_bytes,
                             file_name=f"Quote_{req_from_city}_to_{req_to_city}.docx",
                             mime="application/vnd.openxmlformats-officedocument.wordprocessingml.document"
                         )
@@ -504,17 +266,16 @@ with tab1:
                     
                     if not API_KEY:
                         st.error("Geoapify API key not found. Estimation is disabled.")
-                        if log_sheet:
-                            log_data.extend(["Not Found (No API Key)", 0, "N/A"])
-                            log_sheet.append_row(log_data)
+                        log_data.extend(["Not Found (No API Key)", 0, "N/A"])
+                        log_requests(log_sheet, [log_data])
                     elif rate_result.empty:
                         st.error(f"No rate found for '{req_truck_type}' in '{req_currency}' in rate_list. Estimation failed.")
-                        if log_sheet:
-                            log_data.extend(["Estimation Failed (No Rate)", 0, "N/A"])
-                            log_sheet.append_row(log_data)
+                        log_data.extend(["Estimation Failed (No Rate)", 0, "N/A"])
+                        log_requests(log_sheet, [log_data])
                     else:
                         rate_per_km = rate_result.iloc[0]['Rate_per_KM']
                         distance_km = None
+                        failure_status = "Estimation Failed (API Error)"
                         
                         cache_result = distance_cache_df[
                             (distance_cache_df['From_Country'].str.lower() == req_from_country.lower()) &
@@ -528,11 +289,17 @@ with tab1:
                             st.info(f"Distance found in cache: **{distance_km:,.0f} KM**")
                         else:
                             with st.spinner("Calculating driving distance (API)..."):
-                                distance_km = get_driving_distance(
-                                    req_from_city, req_from_country,
-                                    req_to_city, req_to_country,
-                                    API_KEY
-                                )
+                                try:
+                                    distance_km = get_driving_distance(
+                                        req_from_city, req_from_country,
+                                        req_to_city, req_to_country,
+                                        API_KEY
+                                    )
+                                except ServiceUnavailable as e:
+                                    st.error(f"Distance service unavailable: {e}")
+                                    failure_status = "Estimation Failed (Service Unavailable)"
+                                except ExternalCallFailed as e:
+                                    st.error(f"Distance lookup failed: {e}")
                             if distance_km:
                                 st.success("API call successful. Saving to cache.")
                                 cache_data = [req_from_country, req_from_city, req_to_country, req_to_city, float(distance_km)]
@@ -544,12 +311,10 @@ with tab1:
                             st.info(f"Distance: **{distance_km:,.0f} KM**")
                             st.metric(label="Estimated Price", value=f"{estimated_price:,.2f} {req_currency}")
 
-                            if log_sheet:
-                                log_data.extend(["Estimated", float(estimated_price), req_currency])
-                                log_sheet.append_row(log_data)
+                            log_data.extend(["Estimated", float(estimated_price), req_currency])
+                            log_requests(log_sheet, [log_data])
                             
                             try:
-                                doc = DocxTemplate("quote_template.docx")
                                 context = {
                                     'client_company_summary': client_company_summary,
                                     'scope_summary': req_scope_summary,
@@ -560,12 +325,9 @@ with tab1:
                                     'price': f"{estimated_price:,.2f} (Estimated)", 
                                     'terms_and_conditions': final_terms # <-- Use the final edited text
                                 }
-                                doc.render(context)
-                                file_stream = BytesIO()
-                                doc.save(file_stream)
-                                file_stream.seek(0)
+                                quote_bytes = render_quote_docx(context)
                                 st.download_button(
-                                    label="⬇️ Download *Estimated* Quote as .docx", data=file_stream,
+                                    label="⬇️ Download *Estimated* Quote as .docx", data=quote_bytes,
                                     file_name=f"ESTIMATE_{req_from_city}_to_{req_to_city}.docx",
                                     mime="application/vnd.openxmlformats-officedocument.wordprocessingml.document"
                                 )
@@ -573,9 +335,28 @@ with tab1:
                                 st.error(f"Error generating Word doc: {e}")
                         else:
                             st.error("Estimation failed. Could not calculate distance.")
-                            if log_sheet:
-                                log_data.extend(["Estimation Failed (API Error)", 0, "N/A"])
-                                log_sheet.append_row(log_data)
+                            log_data.extend([failure_status, 0, "N/A"])
+                            log_requests(log_sheet, [log_data])
+
+                    # --- 3. NEAREST CONTRACT-PRICED LANES ---
+                    query_lane = pd.DataFrame([{
+                        'From_Country': req_from_country, 'From_City': req_from_city,
+                        'To_Country': req_to_country, 'To_City': req_to_city,
+                        'Truck_Type': req_truck_type
+                    }])
+                    nearest, new_geocodes = find_nearest_priced_lanes(
+                        query_lane, req_currency, df, geocode_cache_df, API_KEY,
+                        budget=CallBudget(NEAREST_GEOCODE_MAX_CALLS, NEAREST_GEOCODE_MAX_SECONDS)
+                    )
+                    if new_geocodes:
+                        save_to_geocode_cache(client, new_geocodes)
+                    if not nearest.empty:
+                        st.subheader("Nearest contract-priced lanes")
+                        st.caption(f"Closest '{req_truck_type}' lanes in {req_currency} with an exact price in price_list.")
+                        st.dataframe(nearest[[
+                            'From_City', 'From_Country', 'To_City', 'To_Country', 'Price',
+                            'Origin_Offset_KM', 'Destination_Offset_KM'
+                        ]], hide_index=True)
 
 # --- TAB 2: BATCH UPLOAD ---
 with tab2:
@@ -605,22 +386,28 @@ with tab2:
     st.info("""
         **Instructions:**
         1. Upload an Excel file (`.xlsx`) with: `From_Country`, `From_City`, `To_Country`, `To_City`, `Truck_Type`
-        2. Select **one** currency below for all estimations.
+        2. Select **one or more** currencies below. Each gets its own price column.
         3. The tool will find exact prices or *estimate* using your 'rate_list' and 'distance_cache' sheets.
+           Distances are looked up once per lane, however many currencies you pick.
     """)
     
     currency_list_batch = rates_df['Currency'].unique()
-    batch_currency = st.selectbox("Desired Currency (for all estimations)", currency_list_batch, key="batch_currency")
+    batch_currencies = st.multiselect("Desired Currencies (for all estimations)", currency_list_batch,
+                                      default=list(currency_list_batch[:1]), key="batch_currencies")
     
     batch_prepared_by = st.text_input("Quote Prepared by:", key="batch_prepared_by")
     uploaded_file = st.file_uploader("Upload Excel File", type=["xlsx"])
     
-    if uploaded_file and batch_prepared_by and log_sheet:
+    if uploaded_file and batch_prepared_by and log_sheet and not batch_currencies:
+        st.warning("Please select at least one currency.")
+    elif uploaded_file and batch_prepared_by and not log_sheet:
+        st.error("Batch pricing is disabled until the request_log sheet is reachable. Reload the page to retry.")
+    elif uploaded_file and batch_prepared_by and log_sheet:
         
         gemini_api_key = st.secrets.get("gemini_api_key")
         API_KEY = st.secrets.get("geoapify_api_key") 
         ai_model = None
-        client_company_summary = "Client details as provided by user." 
+        client_company_summary = DEFAULT_CLIENT_SUMMARY
         
         if gemini_api_key and batch_client_company_name:
             cache_result = client_summary_cache_df[
@@ -634,9 +421,10 @@ with tab2:
                 ai_model = configure_gemini(gemini_api_key)
                 with st.spinner("Generating AI Client Summary..."):
                     client_company_summary = get_ai_client_summary(ai_model, batch_client_company_name)
-                    cache_data = [batch_client_company_name, client_company_summary]
-                    save_to_client_summary_cache(client, cache_data)
-                    st.success("New summary saved to cache.")
+                    if client_company_summary != DEFAULT_CLIENT_SUMMARY:
+                        cache_data = [batch_client_company_name, client_company_summary]
+                        save_to_client_summary_cache(client, cache_data)
+                        st.success("New summary saved to cache.")
                     
         elif gemini_api_key and not batch_client_company_name:
             st.info("No company name entered, skipping AI summary.")
@@ -650,114 +438,87 @@ with tab2:
             if not all(col in upload_df.columns for col in required_cols):
                 st.error(f"File is missing one of the required columns: {required_cols}")
             else:
-                price_results = []
-                currency_results = []
-                status_results = []
-                logs_to_append = []
-                new_cache_entries = [] 
-                
                 timestamp = datetime.datetime.now().strftime("%Y-%m-%d %H:%M:%S")
 
-                with st.spinner(f"Processing {len(upload_df)} rows... This may take time."):
-                    for index, row in upload_df.iterrows():
-                        
-                        price = 0
-                        currency = "N/A"
-                        status = "Not Found"
-                        
-                        result = df[
-                            (df['From_Country'].str.lower() == str(row['From_Country']).lower()) &
-                            (df['To_Country'].str.lower() == str(row['To_Country']).lower()) &
-                            (df['Truck_Type'] == row['Truck_Type']) &
-                            (df['From_City'].str.lower() == str(row['From_City']).lower()) &
-                            (df['To_City'].str.lower() == str(row['To_City']).lower()) &
-                            (df['Currency'] == batch_currency)
-                        ]
-                        
-                        if not result.empty:
-                            price = result.iloc[0]['Price']
-                            currency = result.iloc[0]['Currency']
-                            status = "Price Found"
-                            price_results.append(price)
-                            currency_results.append(currency)
-                            status_results.append(status)
-                        else:
-                            rate_result = rates_df[
-                                (rates_df['Truck_Type'] == row['Truck_Type']) &
-                                (rates_df['Currency'] == batch_currency)
-                            ]
-                            
-                            if not API_KEY:
-                                status = "Not Found (No API Key)"
-                            elif rate_result.empty:
-                                status = f"Estimation Failed (No Rate for {batch_currency})"
-                            else:
-                                rate_per_km = rate_result.iloc[0]['Rate_per_KM']
-                                currency = batch_currency 
-                                distance_km = None
-
-                                cache_result = distance_cache_df[
-                                    (distance_cache_df['From_Country'].str.lower() == str(row['From_Country']).lower()) &
-                                    (distance_cache_df['From_City'].str.lower() == str(row['From_City']).lower()) &
-                                    (distance_cache_df['To_Country'].str.lower() == str(row['To_Country']).lower()) &
-                                    (distance_cache_df['To_City'].str.lower() == str(row['To_City']).lower())
-                                ]
-                                
-                                if not cache_result.empty:
-                                    distance_km = cache_result.iloc[0]['Distance_KM']
-                                    status = "Estimated (Cache)"
-                                else:
-                                    distance_km = get_driving_distance(
-                                        row['From_City'], row['From_Country'],
-                                        row['To_City'], row['To_Country'], API_KEY
-                                    )
-                                    if distance_km:
-                                        status = "Estimated (API)"
-                                        new_cache_entries.append([
-                                            row['From_Country'], row['From_City'],
-                                            row['To_Country'], row['To_City'],
-                                            float(distance_km)
-                                        ])
-                                    else:
-                                        status = "Estimation Failed (API Error)"
-                                
-                                if "Estimated" in status:
-                                    price = distance_km * rate_per_km
-                                    
-                            price_results.append(price if "Estimated" in status else "NOT FOUND")
-                            currency_results.append(currency)
-                            status_results.append(status)
-                        
+                budget = CallBudget()
+                with st.spinner(f"Processing {len(upload_df)} rows in {len(batch_currencies)} currencies... This may take time."):
+                    currency_results, new_cache_entries = price_batch(
+                        upload_df, batch_currencies, df, rates_df, distance_cache_df, API_KEY,
+                        budget=budget
+                    )
+                if budget.exhausted:
+                    st.warning(f"Batch API budget used up ({budget.calls} calls). Remaining lanes use cached distances only.")
+                if get_circuit_breakers()["geoapify"].is_open:
+                    st.warning("Geoapify is unavailable right now. Uncached lanes were not estimated.")
+                
+                logs_to_append = []
+                for cur, res in currency_results.items():
+                    for row, status, price, currency in zip(
+                        upload_df[required_cols].itertuples(index=False),
+                        res['Status'], res['Log_Price'], res['Currency']
+                    ):
                         logs_to_append.append([
                             timestamp, "Batch", batch_prepared_by,
                             batch_client_type, batch_client_company_name, batch_client_contact_name,
                             batch_client_contact_email, batch_client_contact_phone,
-                            row['From_Country'], row['From_City'], row['To_Country'], row['To_City'],
-                            row['Truck_Type'], status, float(price), currency
+                            row.From_Country, row.From_City, row.To_Country, row.To_City,
+                            row.Truck_Type, status, float(price), currency
                         ])
                 
                 if new_cache_entries:
                     st.info(f"Saving {len(new_cache_entries)} new lanes to distance cache...")
-                    try:
-                        spreadsheet = client.open("price_list")
-                        cache_sheet = spreadsheet.worksheet("distance_cache")
-                        cache_sheet.append_rows(new_cache_entries)
-                        load_distance_cache.clear() 
-                    except Exception as e:
-                        st.warning(f"Failed to save new cache entries: {e}")
-
-                upload_df['Price'] = price_results
-                upload_df['Currency'] = currency_results
-                upload_df['Status'] = status_results
+                    save_rows_to_distance_cache(client, new_cache_entries)
+
+                # Nearest contract-priced lane for every miss, one KD-tree query per truck type
+                nearest_results = {}
+                new_geocodes = []
+                with st.spinner("Finding nearest contract-priced lanes for estimated rows..."):
+                    for cur, res in currency_results.items():
+                        misses = upload_df.loc[res['Status'] != "Price Found", required_cols]
+                        nearest, geocoded = find_nearest_priced_lanes(
+                            misses, cur, df,
+                            pd.concat([geocode_cache_df, pd.DataFrame(new_geocodes, columns=['City', 'Country', 'Lon', 'Lat'])],
+                                      ignore_index=True),
+                            API_KEY, k=1, budget=budget
+                        )
+                        new_geocodes += geocoded
+                        nearest_results[cur] = (
+                            nearest.set_index('Query_Index') if not nearest.empty else pd.DataFrame()
+                        )
+                if new_geocodes:
+                    save_to_geocode_cache(client, new_geocodes)
+
+                def add_nearest_columns(nearest, suffix=""):
+                    if nearest.empty:
+                        upload_df[f'Nearest_Priced_Lane{suffix}'] = ""
+                        upload_df[f'Nearest_Price{suffix}'] = np.nan
+                        upload_df[f'Nearest_Offset_KM{suffix}'] = np.nan
+                        return
+                    lane_text = (nearest['From_City'] + ", " + nearest['From_Country'] + " to "
+                                 + nearest['To_City'] + ", " + nearest['To_Country'])
+                    upload_df[f'Nearest_Priced_Lane{suffix}'] = lane_text.reindex(upload_df.index).fillna("")
+                    upload_df[f'Nearest_Price{suffix}'] = nearest['Price'].reindex(upload_df.index)
+                    upload_df[f'Nearest_Offset_KM{suffix}'] = (
+                        nearest['Origin_Offset_KM'] + nearest['Destination_Offset_KM']
+                    ).reindex(upload_df.index)
+
+                if len(batch_currencies) == 1:
+                    res = currency_results[batch_currencies[0]]
+                    upload_df['Price'] = res['Price']
+                    upload_df['Currency'] = res['Currency']
+                    upload_df['Status'] = res['Status']
+                    add_nearest_columns(nearest_results[batch_currencies[0]])
+                else:
+                    for cur, res in currency_results.items():
+                        upload_df[f'Price_{cur}'] = res['Price']
+                        upload_df[f'Status_{cur}'] = res['Status']
+                        add_nearest_columns(nearest_results[cur], suffix=f"_{cur}")
                 
                 st.success("File processing complete!")
                 st.dataframe(upload_df)
                 
-                try:
-                    log_sheet.append_rows(logs_to_append)
+                if log_requests(log_sheet, logs_to_append):
                     st.info(f"Successfully logged {len(logs_to_append)} requests.")
-                except Exception as e:
-                    st.warning(f"Failed to log batch requests: {e}")
 
                 output_excel = BytesIO()
                 with pd.ExcelWriter(output_excel, engine='openpyxl') as writer:
@@ -769,8 +530,6 @@ with tab2:
                 )
                 
                 try:
-                    doc = DocxTemplate("quote_template.docx")
-                    
                     # --- THIS IS THE LOGIC ---
                     # Find the default T&Cs to pass to the batch cover letter
                     default_terms = "1. Price is valid for 7 days." # Fallback
@@ -788,12 +547,9 @@ with tab2:
                         'currency': "See attached Excel", 'price': "See attached Excel", 
                         'terms_and_conditions': default_terms # <-- Use default T&Cs
                     }
-                    doc.render(context)
-                    file_stream = BytesIO()
-                    doc.save(file_stream)
-                    file_stream.seek(0)
+                    quote_bytes = render_quote_docx(context)
                     st.download_button(
-                        label="⬇️ Download Quote Cover Letter (.docx)", data=file_stream,
+                        label="⬇️ Download Quote Cover Letter (.docx)", data=quote_bytes,
                         file_name=f"Quote_Cover_Letter_{batch_prepared_by}.docx",
                         mime="application/vnd.openxmlformats-officedocument.wordprocessingml.document",
                         key="word_batch_download"
@@ -804,6 +560,20 @@ with tab2:
         except Exception as e:
             st.error(f"An error occurred during file processing: {e}")
 
+# --- TAB 3: ANALYTICS ---
+with tab3:
+    st.header("Request Log Analytics")
+    st.info("Reports run on the local copy of request_log, so they don't download the Google Sheet.")
+    report_name = st.selectbox("Report", list(LogStore.REPORTS), key="analytics_report")
+    try:
+        started = time.perf_counter()
+        report_df = get_log_store().run_report(report_name)
+        elapsed_ms = (time.perf_counter() - started) * 1000
+        st.caption(f"{len(report_df)} rows in {elapsed_ms:,.1f} ms")
+        st.dataframe(report_df)
+    except Exception as e:
+        st.error(f"Failed to run report: {e}")
+
 # (The optional data tables at the bottom are now commented out)
 
 # st.markdown("---")
@@ -0,0 +1,493 @@
+"""Concurrent-user load test for the quoting tool.
+
+Drives app.py headlessly through Streamlit's AppTest with N simulated reps,
+each running a mix of single-lane quotes and batch uploads. Google Sheets,
+Geoapify and Gemini are replaced with in-process fakes (with configurable
+latency), so no credentials or network access are needed.
+
+Usage:
+    python load_test.py --users 8 --iterations 5 --batch-share 0.25 --batch-rows 50
+
+Reports throughput, p50/p95/p99 latency per stage, peak process memory and
+how often each quote status was logged (e.g. cache vs API estimates).
+
+Tested with Streamlit 1.66.0. Running many AppTest sessions at once needs a
+few patches to private Streamlit internals (see shared_runtime_patches), so
+other versions may not work; the harness checks for those internals first
+and exits with a message if any are missing. To get the tested version:
+    pip install streamlit==1.66.0
+"""
+import argparse
+import contextlib
+import io
+import json
+import os
+import random
+import resource
+import sys
+import tempfile
+import threading
+import time
+from collections import defaultdict
+from unittest import mock
+
+import numpy as np
+import pandas as pd
+
+APP_PATH = os.path.join(os.path.dirname(os.path.abspath(__file__)), "app.py")
+TESTED_STREAMLIT_VERSION = "1.66.0"
+
+CITIES = {
+    "UAE": ["Dubai", "Abu Dhabi", "Sharjah", "Ajman", "Al Ain", "Fujairah", "Ruwais", "Jebel Ali"],
+    "KSA": ["Riyadh", "Jeddah", "Dammam", "Jubail", "Yanbu", "Tabuk"],
+    "Oman": ["Muscat", "Sohar", "Salalah"],
+}
+TRUCKS = ["Box - 2 Axle 12M", "Flatbed - 3 Axle 13.6M", "Lorry 5 Ton", "Reefer 10 Ton"]
+CURRENCIES = ["AED", "SAR"]
+
+
+# --- TIMINGS ---
+class Timings:
+    def __init__(self):
+        self._samples = defaultdict(list)
+        self._lock = threading.Lock()
+
+    def add(self, stage, seconds):
+        with self._lock:
+            self._samples[stage].append(seconds)
+
+    def timed(self, stage, fn):
+        def wrapper(*args, **kwargs):
+            started = time.perf_counter()
+            try:
+                return fn(*args, **kwargs)
+            finally:
+                self.add(stage, time.perf_counter() - started)
+        return wrapper
+
+    def summary(self):
+        rows = []
+        with self._lock:
+            for stage, samples in sorted(self._samples.items()):
+                ms = np.array(samples) * 1000
+                rows.append({
+                    "stage": stage, "count": len(ms),
+                    "p50_ms": np.percentile(ms, 50), "p95_ms": np.percentile(ms, 95),
+                    "p99_ms": np.percentile(ms, 99), "max_ms": ms.max(),
+                })
+        return pd.DataFrame(rows)
+
+
+# --- LOCAL FAKES ---
+def random_lane(rng):
+    from_country, to_country = rng.choice(list(CITIES)), rng.choice(list(CITIES))
+    return from_country, rng.choice(CITIES[from_country]), to_country, rng.choice(CITIES[to_country])
+
+def build_sheets(rng):
+    price_rows = []
+    for _ in range(200):
+        from_country, from_city, to_country, to_city = random_lane(rng)
+        price_rows.append({
+            "From_Country": from_country, "From_City": from_city,
+            "To_Country": to_country, "To_City": to_city,
+            "Truck_Type": rng.choice(TRUCKS), "Currency": rng.choice(CURRENCIES),
+            "Price": rng.randint(400, 9000),
+        })
+    rate_rows = [
+        {"Truck_Type": truck, "Rate_per_KM": rng.uniform(1.5, 6), "Currency": currency}
+        for truck in TRUCKS for currency in CURRENCIES
+    ]
+    terms_rows = [{"From_Country": "DEFAULT", "To_Country": "", "Terms_Text": "Standard T&Cs apply."}]
+    return {
+        "Sheet1": as_sheet_rows(price_rows), "rate_list": as_sheet_rows(rate_rows),
+        "terms_list": as_sheet_rows(terms_rows),
+        "distance_cache": [["From_Country", "From_City", "To_Country", "To_City", "Distance_KM"]],
+        "client_summary_cache": [["Client_Company_Name", "Summary_Text"]],
+        "geocode_cache": [["City", "Country", "Lon", "Lat"]],
+        "request_log": [[
+            "Timestamp", "Request_Type", "Prepared_By",
+            "Client_Type", "Client_Company", "Contact_Name", "Contact_Email", "Contact_Phone",
+            "From_Country", "From_City", "To_Country", "To_City",
+            "Truck_Type", "Status", "Price", "Currency",
+        ]],
+    }
+
+def as_sheet_rows(records):
+    # Header row plus value rows, the way a worksheet stores them
+    header = list(records[0])
+    return [header] + [[record.get(col, "") for col in header] for record in records]
+
+class FakeWorksheet:
+    """Tab as a list of rows, row 1 being the header, like a real worksheet.
+
+    Appended rows are plain lists, so get_all_records() maps them onto the
+    header the way gspread does; that's what lets the caches warm up.
+    """
+    def __init__(self, backend, title):
+        self.backend = backend
+        self.title = title
+
+    def get_all_records(self):
+        self.backend.sleep()
+        with self.backend.lock:
+            rows = self.backend.tabs[self.title]
+            if not rows:
+                return []
+            header = rows[0]
+            return [
+                {col: (row[i] if i < len(row) else "") for i, col in enumerate(header)}
+                for row in rows[1:]
+            ]
+
+    def row_values(self, index):
+        with self.backend.lock:
+            rows = self.backend.tabs[self.title]
+            return list(rows[index - 1]) if index <= len(rows) else []
+
+    def col_values(self, index):
+        with self.backend.lock:
+            return [row[index - 1] for row in self.backend.tabs[self.title] if len(row) >= index]
+
+    def append_row(self, row):
+        self.append_rows([row])
+
+    def append_rows(self, rows):
+        self.backend.sleep()
+        with self.backend.lock:
+            self.backend.tabs[self.title].extend(list(row) for row in rows)
+
+    def update_title(self, title):
+        with self.backend.lock:
+            self.backend.check_free(title)
+            self.backend.tabs[title] = self.backend.tabs.pop(self.title)
+        self.title = title
+
+class FakeSpreadsheet:
+    def __init__(self, backend):
+        self.backend = backend
+
+    def worksheet(self, title):
+        import gspread
+        with self.backend.lock:
+            if title not in self.backend.tabs:
+                raise gspread.exceptions.WorksheetNotFound(title)
+        return FakeWorksheet(self.backend, title)
+
+    def worksheets(self):
+        with self.backend.lock:
+            return [FakeWorksheet(self.backend, title) for title in self.backend.tabs]
+
+    def add_worksheet(self, title, rows, cols):
+        with self.backend.lock:
+            self.backend.check_free(title)
+            self.backend.tabs[title] = []
+        return FakeWorksheet(self.backend, title)
+
+class FakeSheetsBackend:
+    def __init__(self, tabs, latency):
+        self.tabs = tabs
+        self.latency = latency
+        self.lock = threading.Lock()
+
+    def sleep(self):
+        time.sleep(self.latency)
+
+    def check_free(self, title):
+        # Google Sheets rejects duplicate tab names
+        if title in self.tabs:
+            raise ValueError(f'A sheet with the name "{title}" already exists.')
+
+    def open(self, name):
+        return FakeSpreadsheet(self)
+
+    def set_timeout(self, seconds):
+        pass
+
+def make_fake_requests_get(latency, rng_lock, rng):
+    def fake_get(url, params=None, timeout=None):
+        time.sleep(latency)
+        response = mock.Mock()
+        response.raise_for_status = lambda: None
+        if "geocode" in url:
+            with rng_lock:
+                lon, lat = rng.uniform(46, 58), rng.uniform(17, 27)
+            body = {"features": [{"geometry": {"coordinates": [lon, lat]}}]}
+        else:
+            with rng_lock:
+                body = {"results": [{"distance": rng.uniform(20_000, 1_500_000)}]}
+        response.json = lambda: body
+        return response
+    return fake_get
+
+class FakeGeminiModel:
+    latency = 0.0
+
+    def __init__(self, *args, **kwargs):
+        pass
+
+    def generate_content(self, prompt, request_options=None):
+        time.sleep(self.latency)
+        return mock.Mock(text=f"Summary for: {prompt[:40]}")
+
+def make_fake_file_uploader(upload_bytes):
+    import streamlit as st
+
+    class UploadedFile(io.BytesIO):
+        name = "load_test_lanes.xlsx"
+
+    # Only sessions that set the flag get a file, so single-quote reruns don't re-trigger a batch
+    def fake_file_uploader(*args, **kwargs):
+        if st.session_state.get("_load_test_upload"):
+            return UploadedFile(upload_bytes)
+        return None
+    return fake_file_uploader
+
+def build_upload(rng, rows):
+    lanes = [random_lane(rng) for _ in range(rows)]
+    upload_df = pd.DataFrame(lanes, columns=["From_Country", "From_City", "To_Country", "To_City"])
+    upload_df["Truck_Type"] = [rng.choice(TRUCKS) for _ in range(rows)]
+    buffer = io.BytesIO()
+    upload_df.to_excel(buffer, index=False)
+    return buffer.getvalue()
+
+
+# --- SIMULATED USERS ---
+def new_session(timeout):
+    from streamlit.testing.v1 import AppTest
+    return AppTest.from_file(APP_PATH, default_timeout=timeout)
+
+# AppTest is written for one test at a time: around every run it swaps the
+# process-wide Runtime, config options and st.secrets in and out, which races
+# when sessions run on parallel threads. These patches install one shared copy
+# of each for the whole load test instead, which is also what a real server
+# process looks like (one runtime and one set of caches for every session).
+def check_streamlit_internals():
+    """Exits with a clear message if the private Streamlit APIs the patches rely on are missing."""
+    import importlib
+    import streamlit
+    required = [
+        ("streamlit.runtime", "Runtime.instance"),
+        ("streamlit.runtime", "Runtime.exists"),
+        ("streamlit.runtime.caching.storage.dummy_cache_storage", "MemoryCacheStorageManager"),
+        ("streamlit.runtime.dataframe_source_manager", "DataframeSourceManager"),
+        ("streamlit.runtime.media_file_manager", "MediaFileManager"),
+        ("streamlit.runtime.memory_media_file_storage", "MemoryMediaFileStorage"),
+        ("streamlit.runtime.scriptrunner.script_cache", "ScriptCache.get_bytecode"),
+        ("streamlit.runtime.secrets", "Secrets"),
+        ("streamlit.testing.v1", "AppTest.from_file"),
+        ("streamlit.testing.v1.app_test", "patch_config_options"),
+        ("streamlit.testing.v1.util", "patch_config_options"),
+    ]
+    missing = []
+    for module_name, attr_path in required:
+        try:
+            obj = importlib.import_module(module_name)
+            for attr in attr_path.split("."):
+                obj = getattr(obj, attr)
+        except (ImportError, AttributeError):
+            missing.append(f"{module_name}.{attr_path}")
+    if missing:
+        sys.exit(
+            f"load_test.py needs Streamlit internals missing from Streamlit {streamlit.__version__}: "
+            f"{', '.join(missing)}. It was tested with {TESTED_STREAMLIT_VERSION} "
+            f"(pip install streamlit=={TESTED_STREAMLIT_VERSION})."
+        )
+    if streamlit.__version__ != TESTED_STREAMLIT_VERSION:
+        print(f"Warning: load_test.py was tested with Streamlit {TESTED_STREAMLIT_VERSION}, "
+              f"running {streamlit.__version__}.", file=sys.stderr)
+
+def shared_runtime_patches(secret_values):
+    import streamlit
+    from streamlit.runtime import Runtime
+    from streamlit.runtime.caching.storage.dummy_cache_storage import MemoryCacheStorageManager
+    from streamlit.runtime.dataframe_source_manager import DataframeSourceManager
+    from streamlit.runtime.media_file_manager import MediaFileManager
+    from streamlit.runtime.memory_media_file_storage import MemoryMediaFileStorage
+    from streamlit.runtime.scriptrunner.script_cache import ScriptCache
+    from streamlit.runtime.secrets import Secrets
+    from streamlit.testing.v1 import app_test
+    from streamlit.testing.v1.util import patch_config_options
+
+    runtime = mock.MagicMock(spec=Runtime)
+    runtime.media_file_mgr = MediaFileManager(MemoryMediaFileStorage("/mock/media"))
+    runtime.dataframe_source_mgr = DataframeSourceManager()
+    runtime.cache_storage_manager = MemoryCacheStorageManager()
+
+    secrets = Secrets()
+    secrets._secrets = secret_values
+
+    # Each AppTest owns a ScriptCache, so app.py is compiled concurrently on first
+    # run, and concurrent ast.parse can fail on CPython 3.11. Compile one at a time.
+    compile_lock = threading.Lock()
+    get_bytecode = ScriptCache.get_bytecode
+
+    def locked_get_bytecode(self, script_path):
+        with compile_lock:
+            return get_bytecode(self, script_path)
+
+    return [
+        mock.patch.object(Runtime, "instance", classmethod(lambda cls: runtime)),
+        mock.patch.object(Runtime, "exists", classmethod(lambda cls: True)),
+        patch_config_options({"global.appTest": True}),
+        mock.patch.object(app_test, "patch_config_options", lambda options: mock.MagicMock()),
+        mock.patch.object(streamlit, "secrets", secrets),
+        mock.patch.object(ScriptCache, "get_bytecode", locked_get_bytecode),
+    ]
+
+def run_single_quote(at, rng, user_id):
+    from_country, from_city, to_country, to_city = random_lane(rng)
+    at.selectbox(key="single_from_country").set_value(from_country)
+    at.selectbox(key="single_to_country").set_value(to_country)
+    at.text_input(key="single_from_city").set_value(from_city)
+    at.text_input(key="single_to_city").set_value(to_city)
+    at.selectbox(key="single_truck_type").set_value(rng.choice(TRUCKS))
+    at.selectbox(key="single_currency").set_value(rng.choice(CURRENCIES))
+    at.text_input(key="single_company").set_value(f"Client {rng.randint(1, 20)}")
+    at.text_input(key="single_prepared_by").set_value(f"rep{user_id}")
+    at.button(key="single_button").click().run()
+
+def run_batch(at, rng, user_id):
+    at.text_input(key="batch_prepared_by").set_value(f"rep{user_id}")
+    at.text_input(key="batch_company").set_value(f"Client {rng.randint(1, 20)}")
+    at.multiselect(key="batch_currencies").set_value(rng.sample(CURRENCIES, rng.randint(1, len(CURRENCIES))))
+    at.session_state["_load_test_upload"] = True
+    at.run()
+    at.session_state["_load_test_upload"] = False
+
+def simulate_user(user_id, args, timings, errors, seed):
+    rng = random.Random(seed)
+    try:
+        at = new_session(args.timeout)
+        started = time.perf_counter()
+        at.run()
+        timings.add("page_load", time.perf_counter() - started)
+        if at.exception:
+            errors.append(f"user {user_id} page_load: {at.exception[0].message}")
+            return
+        for _ in range(args.iterations):
+            workflow = "batch_upload" if rng.random() < args.batch_share else "single_quote"
+            started = time.perf_counter()
+            if workflow == "batch_upload":
+                run_batch(at, rng, user_id)
+            else:
+                run_single_quote(at, rng, user_id)
+            timings.add(workflow, time.perf_counter() - started)
+            if at.exception:
+                errors.append(f"user {user_id} {workflow}: {at.exception[0].message}")
+            if args.think_time:
+                time.sleep(rng.uniform(0, args.think_time))
+    except Exception as e:
+        errors.append(f"user {user_id}: {e!r}")
+
+
+# --- MAIN ---
+def parse_args(argv=None):
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument("--users", type=int, default=4, help="concurrent simulated reps")
+    parser.add_argument("--iterations", type=int, default=5, help="workflows per rep")
+    parser.add_argument("--batch-share", type=float, default=0.2, help="fraction of workflows that are batch uploads")
+    parser.add_argument("--batch-rows", type=int, default=50, help="lanes per batch upload")
+    parser.add_argument("--sheets-latency-ms", type=float, default=50)
+    parser.add_argument("--geoapify-latency-ms", type=float, default=80)
+    parser.add_argument("--gemini-latency-ms", type=float, default=400)
+    parser.add_argument("--think-time", type=float, default=0.0, help="max random pause between workflows (s)")
+    parser.add_argument("--timeout", type=float, default=300, help="per-rerun AppTest timeout (s)")
+    parser.add_argument("--seed", type=int, default=0)
+    parser.add_argument("--json", action="store_true", help="print the report as JSON")
+    return parser.parse_args(argv)
+
+def main(argv=None):
+    args = parse_args(argv)
+    check_streamlit_internals()
+    rng = random.Random(args.seed)
+    rng_lock = threading.Lock()
+    timings = Timings()
+    errors = []
+
+    import gspread
+    import docxtpl
+    import requests
+    import streamlit
+    import google.generativeai as genai
+    from google.oauth2.service_account import Credentials
+
+    sheets = FakeSheetsBackend(build_sheets(rng), args.sheets_latency_ms / 1000)
+    FakeGeminiModel.latency = args.gemini_latency_ms / 1000
+    fake_get = make_fake_requests_get(args.geoapify_latency_ms / 1000, rng_lock, random.Random(args.seed + 1))
+    work_dir = tempfile.mkdtemp(prefix="quote_load_test_")
+    secrets = {
+        "google_credentials": {},
+        "geoapify_api_key": "fake",
+        "gemini_api_key": "fake",
+        "log_db_path": os.path.join(work_dir, "request_log.db"),
+    }
+
+    patches = shared_runtime_patches(secrets) + [
+        mock.patch.object(Credentials, "from_service_account_info", lambda *a, **k: None),
+        mock.patch.object(gspread, "authorize", lambda creds: sheets),
+        mock.patch.object(FakeWorksheet, "get_all_records", timings.timed("sheets_read", FakeWorksheet.get_all_records)),
+        mock.patch.object(FakeWorksheet, "append_rows", timings.timed("sheets_write", FakeWorksheet.append_rows)),
+        mock.patch.object(requests, "get", timings.timed("geoapify_request", fake_get)),
+        mock.patch.object(genai, "configure", lambda **kwargs: None),
+        mock.patch.object(genai, "GenerativeModel", FakeGeminiModel),
+        mock.patch.object(FakeGeminiModel, "generate_content", timings.timed("gemini", FakeGeminiModel.generate_content)),
+        mock.patch.object(docxtpl.DocxTemplate, "render", timings.timed("docx_render", docxtpl.DocxTemplate.render)),
+        mock.patch.object(docxtpl.DocxTemplate, "save", timings.timed("docx_save", docxtpl.DocxTemplate.save)),
+        mock.patch.object(streamlit, "file_uploader", make_fake_file_uploader(build_upload(rng, args.batch_rows))),
+    ]
+    # app.py opens quote_template.docx relative to the working directory
+    os.chdir(os.path.dirname(APP_PATH))
+    with contextlib.ExitStack() as stack:
+        for patch in patches:
+            stack.enter_context(patch)
+        threads = [
+            threading.Thread(target=simulate_user, args=(i, args, timings, errors, args.seed + 100 + i))
+            for i in range(args.users)
+        ]
+        started = time.perf_counter()
+        for thread in threads:
+            thread.start()
+        for thread in threads:
+            thread.join()
+        wall_seconds = time.perf_counter() - started
+
+    stages = timings.summary()
+    statuses = defaultdict(int)
+    for title, rows in sheets.tabs.items():
+        if title.startswith("request_log") and rows:
+            status_col = rows[0].index("Status")
+            for row in rows[1:]:
+                statuses[row[status_col]] += 1
+    workflows = stages[stages["stage"].isin(["single_quote", "batch_upload"])]["count"].sum() if not stages.empty else 0
+    single = stages.loc[stages["stage"] == "single_quote", "count"].sum() if not stages.empty else 0
+    batches = stages.loc[stages["stage"] == "batch_upload", "count"].sum() if not stages.empty else 0
+    report = {
+        "users": args.users,
+        "wall_seconds": round(wall_seconds, 3),
+        "workflows": int(workflows),
+        "workflows_per_second": round(workflows / wall_seconds, 3) if wall_seconds else 0.0,
+        "lanes_priced_per_second": round((single + batches * args.batch_rows) / wall_seconds, 3) if wall_seconds else 0.0,
+        # ru_maxrss is KB on Linux, bytes on macOS
+        "peak_rss_mb": round(resource.getrusage(resource.RUSAGE_SELF).ru_maxrss / (1024 * 1024 if sys.platform == "darwin" else 1024), 1),
+        "statuses": dict(sorted(statuses.items())),
+        "errors": errors,
+        "stages": stages.round(2).to_dict(orient="records"),
+    }
+
+    if args.json:
+        print(json.dumps(report, indent=2, default=float))
+    else:
+        print(f"Users: {report['users']}  Wall: {report['wall_seconds']}s  Workflows: {report['workflows']}")
+        print(f"Throughput: {report['workflows_per_second']} workflows/s, {report['lanes_priced_per_second']} lanes/s")
+        print(f"Peak RSS: {report['peak_rss_mb']} MB")
+        print("Logged statuses: " + ", ".join(f"{status} {count}" for status, count in report["statuses"].items()))
+        print()
+        print(stages.round(2).to_string(index=False) if not stages.empty else "No stages recorded.")
+        if errors:
+            print(f"\n{len(errors)} error(s):")
+            for error in errors[:20]:
+                print(f"  {error}")
+    return 1 if errors else 0
+
+if __name__ == "__main__":
+    sys.exit(main())
@@ -0,0 +1,1125 @@
+"""Quote lookup, estimation and document logic shared by the Streamlit app
+(app.py) and the pricing HTTP service (pricing_api.py).
+
+Everything here is importable without running the UI. Streamlit is still used
+for st.secrets and its caches; since this module is imported once per process,
+those caches (and the circuit breakers, doc cache and lane index) are shared
+by every Streamlit session and every API request in the same process.
+"""
+import streamlit as st
+import pandas as pd
+import numpy as np
+import gspread
+from google.oauth2.service_account import Credentials
+from docxtpl import DocxTemplate
+from io import BytesIO
+import datetime
+import hashlib
+import json
+import os
+import sqlite3
+import time
+import threading
+from collections import OrderedDict
+import requests 
+import google.generativeai as genai 
+from scipy.spatial import cKDTree
+
+# --- EXTERNAL CALL LIMITS (override any of these in secrets.toml) ---
+EXTERNAL_CALL_TIMEOUT = float(st.secrets.get("external_call_timeout_seconds", 15))
+BREAKER_FAILURE_THRESHOLD = int(st.secrets.get("breaker_failure_threshold", 3))
+BREAKER_RESET_SECONDS = float(st.secrets.get("breaker_reset_seconds", 60))
+BATCH_MAX_API_CALLS = int(st.secrets.get("batch_max_api_calls", 500))
+BATCH_MAX_SECONDS = float(st.secrets.get("batch_max_seconds", 300))
+
+# --- LOCAL ANALYTICS STORE SETTINGS ---
+LOG_DB_PATH = st.secrets.get("log_db_path", "request_log.db")
+API_COST_PER_CALL = {
+    "geoapify": float(st.secrets.get("geoapify_cost_per_call", 0.0)),
+    "gemini": float(st.secrets.get("gemini_cost_per_call", 0.0)),
+}
+
+# --- QUOTE DOCUMENT CACHE SETTINGS ---
+QUOTE_TEMPLATE_PATH = "quote_template.docx"
+DOC_CACHE_MAX_ENTRIES = int(st.secrets.get("doc_cache_max_entries", 256))
+DOC_CACHE_MAX_BYTES = int(st.secrets.get("doc_cache_max_mb", 64)) * 1024 * 1024
+DOC_CACHE_DIR = st.secrets.get("doc_cache_dir", "")  # empty disables the disk tier
+DOC_CACHE_DISK_MAX_BYTES = int(st.secrets.get("doc_cache_disk_max_mb", 256)) * 1024 * 1024
+
+# --- NEAREST PRICED LANE SETTINGS ---
+NEAREST_LANES_K = int(st.secrets.get("nearest_lanes_k", 3))
+# Per single quote: geocoding for suggestions must not hold up the quote itself
+NEAREST_GEOCODE_MAX_CALLS = int(st.secrets.get("nearest_geocode_max_calls", 4))
+NEAREST_GEOCODE_MAX_SECONDS = float(st.secrets.get("nearest_geocode_max_seconds", 5))
+EARTH_RADIUS_KM = 6371.0
+
+DEFAULT_CLIENT_SUMMARY = "Client details as provided by user."
+
+# --- 2. GOOGLE SHEETS CONNECTION ---
+@st.cache_resource
+def get_gspread_client():
+    scopes = [
+        'https://www.googleapis.com/auth/spreadsheets',
+        'https://www.googleapis.com/auth/drive'
+    ]
+    creds = Credentials.from_service_account_info(
+        st.secrets["google_credentials"], scopes=scopes
+    )
+    client = gspread.authorize(creds)
+    client.set_timeout(EXTERNAL_CALL_TIMEOUT)
+    return client
+
+# --- 3. LOAD DATA FUNCTIONS (WITH NEW CLEANING) ---
+@st.cache_data(ttl=600)
+def load_data(_client):
+    try:
+        sheet_name = "price_list"
+        spreadsheet = _client.open(sheet_name)
+        worksheet = spreadsheet.worksheet("Sheet1") # Your price list tab
+        
+        data = worksheet.get_all_records()
+        df = pd.DataFrame(data)
+        
+        if df.empty:
+            return pd.DataFrame()
+            
+        for col in df.select_dtypes(include=['object']).columns:
+            df[col] = df[col].astype(str).str.strip()
+        df.columns = df.columns.str.strip() # Clean headers too
+        
+        if 'Price' in df.columns:
+            df['Price'] = pd.to_numeric(df['Price'], errors='coerce')
+        return df
+    except Exception as e:
+        st.error(f"An error occurred while loading price_list data: {e}")
+        return pd.DataFrame()
+
+@st.cache_data(ttl=600)
+def load_rates(_client):
+    try:
+        sheet_name = "price_list"
+        spreadsheet = _client.open(sheet_name)
+        worksheet = spreadsheet.worksheet("rate_list") # Your new rate card tab
+        
+        data = worksheet.get_all_records()
+        df = pd.DataFrame(data)
+        
+        if df.empty:
+            return pd.DataFrame(columns=['Truck_Type', 'Rate_per_KM', 'Currency'])
+            
+        for col in df.select_dtypes(include=['object']).columns:
+            df[col] = df[col].astype(str).str.strip()
+        df.columns = df.columns.str.strip() # Clean headers too
+        
+        if 'Rate_per_KM' in df.columns:
+            df['Rate_per_KM'] = pd.to_numeric(df['Rate_per_KM'], errors='coerce')
+        return df
+    except gspread.exceptions.WorksheetNotFound:
+        st.error("Error: 'rate_list' tab not found in your Google Sheet. Estimation is disabled.")
+        return pd.DataFrame(columns=['Truck_Type', 'Rate_per_KM', 'Currency'])
+    except Exception as e:
+        st.error(f"An error occurred while loading rate_list data: {e}")
+        return pd.DataFrame(columns=['Truck_Type', 'Rate_per_KM', 'Currency'])
+
+@st.cache_data(ttl=600)
+def load_distance_cache(_client):
+    try:
+        sheet_name = "price_list"
+        spreadsheet = _client.open(sheet_name)
+        worksheet = spreadsheet.worksheet("distance_cache") # Your new cache tab
+        
+        data = worksheet.get_all_records()
+        df = pd.DataFrame(data)
+        
+        if df.empty:
+            df = pd.DataFrame(columns=['From_Country', 'From_City', 'To_Country', 'To_City', 'Distance_KM'])
+        
+        df.columns = df.columns.str.strip()
+        
+        if 'Distance_KM' in df.columns:
+            df['Distance_KM'] = pd.to_numeric(df['Distance_KM'], errors='coerce')
+        return df
+    except gspread.exceptions.WorksheetNotFound:
+        st.error("Error: 'distance_cache' tab not found in your Google Sheet. Cache is disabled.")
+        return pd.DataFrame(columns=['From_Country', 'From_City', 'To_Country', 'To_City', 'Distance_KM'])
+    except Exception as e:
+        st.error(f"An error occurred while loading distance_cache data: {e}")
+        return pd.DataFrame(columns=['From_Country', 'From_City', 'To_Country', 'To_City', 'Distance_KM'])
+
+@st.cache_data(ttl=600)
+def load_client_summary_cache(_client):
+    try:
+        sheet_name = "price_list"
+        spreadsheet = _client.open(sheet_name)
+        worksheet = spreadsheet.worksheet("client_summary_cache") # Your new cache tab
+        
+        data = worksheet.get_all_records()
+        df = pd.DataFrame(data)
+        
+        if df.empty:
+            df = pd.DataFrame(columns=['Client_Company_Name', 'Summary_Text'])
+        
+        df.columns = df.columns.str.strip()
+        
+        return df
+    except gspread.exceptions.WorksheetNotFound:
+        st.error("Error: 'client_summary_cache' tab not found in your Google Sheet. AI Cache is disabled.")
+        return pd.DataFrame(columns=['Client_Company_Name', 'Summary_Text'])
+    except Exception as e:
+        st.error(f"An error occurred while loading client_summary_cache data: {e}")
+        return pd.DataFrame(columns=['Client_Company_Name', 'Summary_Text'])
+
+@st.cache_data(ttl=600)
+def load_geocode_cache(_client):
+    try:
+        sheet_name = "price_list"
+        spreadsheet = _client.open(sheet_name)
+        worksheet = spreadsheet.worksheet("geocode_cache") # City coordinates for nearest-lane lookup
+        
+        data = worksheet.get_all_records()
+        df = pd.DataFrame(data)
+        
+        if df.empty:
+            df = pd.DataFrame(columns=['City', 'Country', 'Lon', 'Lat'])
+        
+        df.columns = df.columns.str.strip()
+        
+        for col in ['Lon', 'Lat']:
+            if col in df.columns:
+                df[col] = pd.to_numeric(df[col], errors='coerce')
+        return df
+    except gspread.exceptions.WorksheetNotFound:
+        st.error("Error: 'geocode_cache' tab not found in your Google Sheet. Nearest-lane suggestions will geocode every time.")
+        return pd.DataFrame(columns=['City', 'Country', 'Lon', 'Lat'])
+    except Exception as e:
+        st.error(f"An error occurred while loading geocode_cache data: {e}")
+        return pd.DataFrame(columns=['City', 'Country', 'Lon', 'Lat'])
+
+# --- THIS IS NEW: LOAD T&Cs ---
+@st.cache_data(ttl=600)
+def load_terms(_client):
+    try:
+        sheet_name = "price_list"
+        spreadsheet = _client.open(sheet_name)
+        worksheet = spreadsheet.worksheet("terms_list") # Your new T&C tab
+        
+        data = worksheet.get_all_records()
+        df = pd.DataFrame(data)
+        
+        if df.empty:
+            df = pd.DataFrame(columns=['From_Country', 'To_Country', 'Terms_Text'])
+        
+        for col in df.select_dtypes(include=['object']).columns:
+            df[col] = df[col].astype(str).str.strip()
+        df.columns = df.columns.str.strip()
+        
+        return df
+    except gspread.exceptions.WorksheetNotFound:
+        st.error("Error: 'terms_list' tab not found in your Google Sheet. Default T&Cs will be used.")
+        return pd.DataFrame(columns=['From_Country', 'To_Country', 'Terms_Text'])
+    except Exception as e:
+        st.error(f"An error occurred while loading T&Cs data: {e}")
+        return pd.DataFrame(columns=['From_Country', 'To_Country', 'Terms_Text'])
+
+# --- 4. FUNCTION TO GET LOG SHEET ---
+LOG_COLUMNS = [
+    'Timestamp', 'Request_Type', 'Prepared_By',
+    'Client_Type', 'Client_Company', 'Contact_Name', 'Contact_Email', 'Contact_Phone',
+    'From_Country', 'From_City', 'To_Country', 'To_City',
+    'Truck_Type', 'Status', 'Price', 'Currency'
+]
+
+LOG_STAGING_TITLE = "request_log_next"
+
+def _log_archive_title(first_ts, last_ts, taken):
+    # request_log_YYYY_MM, or request_log_YYYY_MM_to_YYYY_MM for a tab that was never rotated
+    first, last = first_ts[:7].replace("-", "_"), last_ts[:7].replace("-", "_")
+    base = f"request_log_{first}" if first == last else f"request_log_{first}_to_{last}"
+    title, n = base, 2
+    while title in taken:
+        title, n = f"{base}_{n}", n + 1
+    return title
+
+def _rotate_log_sheet(spreadsheet, log_sheet, first_ts, last_ts):
+    # The fresh tab is created (under a staging name) before the old one is renamed, so a
+    # failure at any step leaves a request_log to write to, or a staged one to finish with
+    titles = {ws.title for ws in spreadsheet.worksheets()}
+    header = log_sheet.row_values(1) or LOG_COLUMNS
+    if LOG_STAGING_TITLE in titles:
+        new_sheet = spreadsheet.worksheet(LOG_STAGING_TITLE)
+    else:
+        new_sheet = spreadsheet.add_worksheet(LOG_STAGING_TITLE, rows=1000, cols=len(header))
+    if not new_sheet.row_values(1):
+        new_sheet.append_row(header)
+    log_sheet.update_title(_log_archive_title(first_ts, last_ts, titles))
+    new_sheet.update_title("request_log")
+    return new_sheet
+
+@st.cache_resource
+def _open_log_sheet(_client, month):
+    # Raises on failure so st.cache_resource doesn't keep a broken result for the month
+    spreadsheet = _client.open("price_list")
+    try:
+        log_sheet = spreadsheet.worksheet("request_log")
+    except gspread.exceptions.WorksheetNotFound:
+        # An earlier rotation archived the old tab but didn't get to rename the new one
+        log_sheet = spreadsheet.worksheet(LOG_STAGING_TITLE)
+        log_sheet.update_title("request_log")
+        return log_sheet
+    timestamps = log_sheet.col_values(1)[1:]
+    if timestamps and timestamps[-1][:7].replace("-", "_") != month:
+        log_sheet = _rotate_log_sheet(spreadsheet, log_sheet, timestamps[0], timestamps[-1])
+    return log_sheet
+
+def get_log_sheet(client, month):
+    """The current request_log tab, archiving the previous one the first time a new `month` (YYYY_MM) is seen.
+
+    The tab is rotated when its newest row is from an earlier month. Returns
+    None (after showing the error) if the sheet can't be opened; the next run
+    tries again.
+    """
+    try:
+        return _open_log_sheet(client, month)
+    except Exception as e:
+        st.error(f"Error connecting to log sheet: {e}")
+        return None
+
+class LogStore:
+    """Local SQLite copy of request_log plus external API call counts.
+
+    Every logged request is written here as well as to the Google Sheet, so
+    reporting queries run locally instead of downloading the whole log.
+    A multi-currency quote logs one row (price line) per currency, so the
+    reports count a quote once per timestamp, lane and truck type.
+    """
+    REPORTS = {
+        "Quotes per lane": """
+            SELECT from_country, from_city, to_country, to_city, truck_type,
+                   COUNT(DISTINCT ts || '|' || request_type || '|' || prepared_by) AS quotes,
+                   COUNT(*) AS price_lines,
+                   SUM(status = 'Price Found') AS price_found,
+                   SUM(status LIKE 'Estimated%') AS estimated
+            FROM requests
+            GROUP BY lower(from_country), lower(from_city), lower(to_country), lower(to_city), truck_type
+            ORDER BY quotes DESC
+        """,
+        "Price Found vs Estimated (per day)": """
+            SELECT substr(ts, 1, 10) AS day,
+                   SUM(status = 'Price Found') AS price_found,
+                   SUM(status LIKE 'Estimated%') AS estimated,
+                   ROUND(1.0 * SUM(status = 'Price Found') / COUNT(*), 3) AS price_found_share,
+                   ROUND(1.0 * SUM(status LIKE 'Estimated%') / COUNT(*), 3) AS estimated_share,
+                   COUNT(*) AS price_lines
+            FROM requests
+            GROUP BY day
+            ORDER BY day DESC
+        """,
+        "API cost per day": """
+            SELECT substr(ts, 1, 10) AS day, service,
+                   SUM(calls) AS calls, ROUND(SUM(cost), 4) AS cost
+            FROM api_calls
+            GROUP BY day, service
+            ORDER BY day DESC, service
+        """,
+        "Volume per rep": """
+            SELECT prepared_by, request_type,
+                   COUNT(DISTINCT ts || '|' || lower(from_country) || '|' || lower(from_city) || '|'
+                         || lower(to_country) || '|' || lower(to_city) || '|' || truck_type) AS quotes,
+                   COUNT(*) AS price_lines,
+                   SUM(status = 'Price Found') AS price_found,
+                   SUM(status LIKE 'Estimated%') AS estimated
+            FROM requests
+            GROUP BY lower(prepared_by), request_type
+            ORDER BY quotes DESC
+        """,
+    }
+
+    def __init__(self, path):
+        self._conn = sqlite3.connect(path, check_same_thread=False)
+        self._lock = threading.Lock()
+        with self._lock, self._conn:
+            self._conn.executescript("""
+                CREATE TABLE IF NOT EXISTS requests (
+                    ts TEXT, request_type TEXT, prepared_by TEXT,
+                    client_type TEXT, client_company TEXT, contact_name TEXT,
+                    contact_email TEXT, contact_phone TEXT,
+                    from_country TEXT, from_city TEXT, to_country TEXT, to_city TEXT,
+                    truck_type TEXT, status TEXT, price REAL, currency TEXT
+                );
+                CREATE INDEX IF NOT EXISTS idx_requests_ts ON requests (ts);
+                DROP INDEX IF EXISTS idx_requests_lane;
+                CREATE TABLE IF NOT EXISTS api_calls (ts TEXT, service TEXT, calls INTEGER, cost REAL);
+                CREATE INDEX IF NOT EXISTS idx_api_calls_ts ON api_calls (ts);
+            """)
+
+    def add_requests(self, rows):
+        # Sheet rows may carry numpy scalars from pandas; SQLite only binds plain types
+        clean = [
+            [v if v is None or isinstance(v, (str, int, float)) else (v.item() if hasattr(v, "item") else str(v))
+             for v in row]
+            for row in rows
+        ]
+        with self._lock, self._conn:
+            self._conn.executemany(
+                f"INSERT INTO requests VALUES ({', '.join('?' * len(LOG_COLUMNS))})", clean
+            )
+
+    def record_api_call(self, service, calls=1):
+        ts = datetime.datetime.now().strftime("%Y-%m-%d %H:%M:%S")
+        with self._lock, self._conn:
+            self._conn.execute(
+                "INSERT INTO api_calls VALUES (?, ?, ?, ?)",
+                (ts, service, calls, calls * API_COST_PER_CALL.get(service, 0.0))
+            )
+
+    def run_report(self, name):
+        with self._lock:
+            return pd.read_sql_query(self.REPORTS[name], self._conn)
+
+@st.cache_resource
+def get_log_store():
+    return LogStore(LOG_DB_PATH)
+
+def log_requests(log_sheet, rows):
+    """Writes log rows to the local store and to `log_sheet` (the current request_log tab).
+
+    Returns True when the sheet append succeeded.
+    """
+    try:
+        get_log_store().add_requests(rows)
+    except Exception as e:
+        st.warning(f"Failed to write local analytics log: {e}")
+    if not log_sheet:
+        return False
+    try:
+        log_sheet.append_rows(rows)
+        return True
+    except Exception as e:
+        st.warning(f"Failed to log request: {e}")
+        return False
+
+def record_api_call(service):
+    # Analytics only: a broken local store must never fail the external call being counted
+    try:
+        get_log_store().record_api_call(service)
+    except Exception as e:
+        st.warning(f"Failed to record {service} call in local analytics log: {e}")
+
+# --- 5. CACHE-SAVING FUNCTIONS ---
+def save_to_distance_cache(client, row_data):
+    try:
+        spreadsheet = client.open("price_list")
+        cache_sheet = spreadsheet.worksheet("distance_cache")
+        cache_sheet.append_row(row_data)
+        load_distance_cache.clear()
+    except Exception as e:
+        st.warning(f"Failed to save to distance cache: {e}")
+
+def save_rows_to_distance_cache(client, rows, refresh=True):
+    # refresh=False keeps every session's loaded cache; the rows show up at its next TTL reload
+    try:
+        spreadsheet = client.open("price_list")
+        cache_sheet = spreadsheet.worksheet("distance_cache")
+        cache_sheet.append_rows(rows)
+        if refresh:
+            load_distance_cache.clear()
+    except Exception as e:
+        st.warning(f"Failed to save new cache entries: {e}")
+
+def save_to_client_summary_cache(client, row_data):
+    try:
+        spreadsheet = client.open("price_list")
+        cache_sheet = spreadsheet.worksheet("client_summary_cache")
+        cache_sheet.append_row(row_data)
+        load_client_summary_cache.clear()
+    except Exception as e:
+        st.warning(f"Failed to save to AI summary cache: {e}")
+
+def save_to_geocode_cache(client, rows):
+    try:
+        spreadsheet = client.open("price_list")
+        cache_sheet = spreadsheet.worksheet("geocode_cache")
+        cache_sheet.append_rows(rows)
+        load_geocode_cache.clear()
+    except Exception as e:
+        st.warning(f"Failed to save to geocode cache: {e}")
+
+# --- 6. AI & ESTIMATION FUNCTIONS ---
+class ServiceUnavailable(Exception):
+    """An external call was skipped or failed at the transport level."""
+
+class BudgetExhausted(ServiceUnavailable):
+    """The current batch has used up its API call or time budget."""
+
+class ExternalCallFailed(Exception):
+    """The service answered, but this one request failed (4xx, bad response)."""
+
+class CircuitBreaker:
+    """Stops calling a service after repeated failures.
+
+    After `failure_threshold` consecutive failures the breaker opens and every
+    call is short-circuited for `reset_after` seconds. One trial call is then
+    let through; success closes the breaker, failure re-opens it.
+    """
+    def __init__(self, name, failure_threshold, reset_after):
+        self.name = name
+        self.failure_threshold = failure_threshold
+        self.reset_after = reset_after
+        self._failures = 0
+        self._opened_at = None
+        self._lock = threading.Lock()
+
+    @property
+    def is_open(self):
+        with self._lock:
+            return self._opened_at is not None and time.monotonic() - self._opened_at < self.reset_after
+
+    def allow(self):
+        with self._lock:
+            if self._opened_at is None:
+                return True
+            if time.monotonic() - self._opened_at >= self.reset_after:
+                self._opened_at = time.monotonic()  # half-open: one trial call per window
+                return True
+            return False
+
+    def record_success(self):
+        with self._lock:
+            self._failures = 0
+            self._opened_at = None
+
+    def record_failure(self):
+        with self._lock:
+            self._failures += 1
+            if self._failures >= self.failure_threshold:
+                self._opened_at = time.monotonic()
+
+class CallBudget:
+    """Caps the number of external calls and the wall-clock time of one batch."""
+    def __init__(self, max_calls=BATCH_MAX_API_CALLS, max_seconds=BATCH_MAX_SECONDS):
+        self.max_calls = max_calls
+        self.calls = 0
+        self.deadline = time.monotonic() + max_seconds
+        self._lock = threading.Lock()
+
+    @property
+    def exhausted(self):
+        return self.calls >= self.max_calls or time.monotonic() >= self.deadline
+
+    def take(self):
+        with self._lock:
+            if self.exhausted:
+                raise BudgetExhausted(f"Batch budget used up after {self.calls} API calls.")
+            self.calls += 1
+
+@st.cache_resource
+def get_circuit_breakers():
+    # Shared by every session in this process so one outage trips it for everyone
+    return {
+        name: CircuitBreaker(name, BREAKER_FAILURE_THRESHOLD, BREAKER_RESET_SECONDS)
+        for name in ("geoapify", "gemini")
+    }
+
+def _is_outage(error):
+    # Timeouts, connection errors and 5xx say the service is down; 4xx and bad payloads are per-request
+    if isinstance(error, (requests.Timeout, requests.ConnectionError, TimeoutError, ConnectionError)):
+        return True
+    status = getattr(getattr(error, "response", None), "status_code", None)
+    if status is None:
+        status = getattr(error, "code", None)  # google.api_core errors carry the HTTP status here
+    return isinstance(status, int) and status >= 500
+
+def call_with_breaker(service, fn, *args, **kwargs):
+    """Runs fn(*args, **kwargs) behind the service's circuit breaker.
+
+    Raises ServiceUnavailable for outages (which count towards opening the
+    breaker) and ExternalCallFailed for errors specific to this request
+    (which don't).
+    """
+    breaker = get_circuit_breakers()[service]
+    if not breaker.allow():
+        raise ServiceUnavailable(f"{service} is unavailable (circuit open after repeated failures).")
+    try:
+        result = fn(*args, **kwargs)
+    except BudgetExhausted:
+        raise
+    except Exception as e:
+        if not _is_outage(e):
+            # The service answered, so it's healthy (this also closes a half-open breaker)
+            breaker.record_success()
+            raise ExternalCallFailed(f"{service} call failed: {e}") from e
+        breaker.record_failure()
+        raise ServiceUnavailable(f"{service} call failed: {e}") from e
+    breaker.record_success()
+    return result
+
+def configure_gemini(api_key):
+    genai.configure(api_key=api_key)
+    model = genai.GenerativeModel('models/gemini-flash-latest') 
+    return model
+
+@st.cache_data(ttl=3600)
+def _generate_client_summary(_model, company_name):
+    # Errors propagate so they are never cached
+    prompt = f"Briefly summarize the company '{company_name}' in 2-3 professional lines, focusing on their industry."
+    record_api_call("gemini")
+    response = _model.generate_content(prompt, request_options={"timeout": EXTERNAL_CALL_TIMEOUT})
+    return response.text
+
+def get_ai_client_summary(_model, company_name):
+    if not company_name:
+        return DEFAULT_CLIENT_SUMMARY
+    try:
+        return call_with_breaker("gemini", _generate_client_summary, _model, company_name)
+    except (ServiceUnavailable, ExternalCallFailed) as e:
+        st.warning(f"AI client summary failed: {e}")
+        return DEFAULT_CLIENT_SUMMARY
+
+COUNTRY_MAP = {
+    "UAE": "United Arab Emirates",
+    "KSA": "Saudi Arabia",
+    "Oman": "Oman",
+    "Bahrain": "Bahrain",
+    "Jordan": "Jordan",
+    "Egypt": "Egypt",
+    "Qatar": "Qatar",
+    "Kuwait": "Kuwait"
+}
+
+def _geoapify_get(url, params, budget=None):
+    # Only real HTTP requests count against the batch budget, not cache hits
+    if budget is not None:
+        budget.take()
+    record_api_call("geoapify")
+    resp = requests.get(url, params=params, timeout=EXTERNAL_CALL_TIMEOUT)
+    resp.raise_for_status()
+    return resp.json()
+
+@st.cache_data(ttl=86400)
+def _fetch_geocode(city, country, api_key, _budget=None):
+    # (lon, lat) of the best Geoapify match, or None if the city isn't found
+    geocode_base_url = "https://api.geoapify.com/v1/geocode/search"
+    full_country = COUNTRY_MAP.get(country, country)
+    geocode_params = {
+        "text": f"{city}, {full_country}",
+        "apiKey": api_key
+    }
+    data = _geoapify_get(geocode_base_url, geocode_params, _budget)
+    if not data.get("features"):
+        return None
+    lon, lat = data["features"][0]["geometry"]["coordinates"]
+    return lon, lat
+
+@st.cache_data(ttl=3600)
+def _fetch_driving_distance(from_city, from_country, to_city, to_country, api_key, _budget=None):
+    # Transport errors propagate (and are not cached) so the circuit breaker sees them
+    from_coords = _fetch_geocode(from_city, from_country, api_key, _budget)
+    to_coords = _fetch_geocode(to_city, to_country, api_key, _budget)
+    
+    if not from_coords or not to_coords:
+        st.error("Could not find coordinates for one or more cities. Check spelling.")
+        return None
+
+    from_lon, from_lat = from_coords
+    to_lon, to_lat = to_coords
+
+    routing_base_url = "https://api.geoapify.com/v1/routing"
+    routing_params = {
+        "waypoints": f"{from_lat},{from_lon}|{to_lat},{to_lon}",
+        "mode": "drive", "format": "json", "apiKey": api_key
+    }
+    data_matrix = _geoapify_get(routing_base_url, routing_params, _budget)
+
+    results = data_matrix.get("results")
+    if not results: return None
+    route = results[0]
+    distance_meters = route.get("distance")
+    if distance_meters is None: return None
+    distance_km = distance_meters / 1000
+    return round(distance_km, 2)
+
+def get_driving_distance(from_city, from_country, to_city, to_country, api_key, budget=None):
+    """Driving distance in KM, or None if the lane can't be routed.
+
+    Raises ServiceUnavailable when Geoapify is down, slow or short-circuited,
+    BudgetExhausted when the batch `budget` is used up, and
+    ExternalCallFailed when Geoapify rejects this lane.
+    """
+    return call_with_breaker(
+        "geoapify", _fetch_driving_distance,
+        from_city, from_country, to_city, to_country, api_key,
+        _budget=budget
+    )
+
+LANE_KEY_COLS = ['From_Country', 'From_City', 'To_Country', 'To_City']
+PRICE_KEY_COLS = LANE_KEY_COLS + ['Truck_Type']
+
+def _lane_keys(frame):
+    # Lowercased, stripped lane columns so lookups match the single-quote rules
+    keys = pd.DataFrame(index=frame.index)
+    for col in LANE_KEY_COLS:
+        keys[col] = frame[col].astype(str).str.strip().str.lower()
+    return keys
+
+class BatchPricer:
+    """Prices a set of lanes in all `currencies`, in stages.
+
+    Construction does everything that needs no API call, vectorized: exact
+    price_list matches, rate_list lookups and distance_cache hits. The
+    uncached lanes still needing a Geoapify distance are left in
+    `lanes_to_fetch` (one entry per unique lane, however many rows or
+    currencies share it) for `fetch()`, which is safe to call from several
+    threads. `results()` can be taken for any subset of rows at any time,
+    so callers can either price everything (price_batch) or stream rows as
+    their distances arrive (pricing_api).
+    """
+    def __init__(self, upload_df, currencies, price_df, rates, dist_cache, api_key):
+        self.upload_df = upload_df
+        self.api_key = api_key
+        keys = _lane_keys(upload_df)
+        keys['Truck_Type'] = upload_df['Truck_Type'].astype(str).str.strip()
+        self.keys = keys
+
+        prices = pd.DataFrame(columns=PRICE_KEY_COLS + ['Currency', 'Price'])
+        if not price_df.empty:
+            prices = _lane_keys(price_df)
+            prices['Truck_Type'] = price_df['Truck_Type'].astype(str)
+            prices['Currency'] = price_df['Currency']
+            prices['Price'] = price_df['Price']
+            prices = prices.drop_duplicates(PRICE_KEY_COLS + ['Currency'])
+
+        # Exact price and rate per currency, all vectorized
+        self.per_currency = {}
+        for cur in currencies:
+            matches = prices.loc[prices['Currency'] == cur, PRICE_KEY_COLS + ['Price']]
+            merged = keys.merge(matches.assign(_found=True), on=PRICE_KEY_COLS, how='left')
+            merged.index = keys.index
+            rate_map = (
+                rates[rates['Currency'] == cur]
+                .drop_duplicates('Truck_Type')
+                .set_index('Truck_Type')['Rate_per_KM']
+            )
+            self.per_currency[cur] = {
+                'found': merged['_found'].notna(),
+                'price': merged['Price'],
+                'has_rate': keys['Truck_Type'].isin(rate_map.index),
+                'rate': keys['Truck_Type'].map(rate_map),
+            }
+
+        # Distances: only for rows where some currency needs an estimate
+        self.distances = pd.Series(np.nan, index=keys.index)
+        self.dist_source = pd.Series("", index=keys.index)
+        self.lanes_to_fetch = {}
+        self._lock = threading.Lock()
+        needs_distance = pd.Series(False, index=keys.index)
+        for info in self.per_currency.values():
+            needs_distance |= ~info['found'] & info['has_rate']
+
+        if api_key and needs_distance.any():
+            wanted = keys.loc[needs_distance, LANE_KEY_COLS]
+            if not dist_cache.empty:
+                cached = _lane_keys(dist_cache)
+                cached['Distance_KM'] = dist_cache['Distance_KM']
+                cached = cached.drop_duplicates(LANE_KEY_COLS)
+                hits = wanted.merge(cached, on=LANE_KEY_COLS, how='left', indicator=True)
+                hits.index = wanted.index
+                in_cache = hits['_merge'] == 'both'
+                self.distances[in_cache[in_cache].index] = hits.loc[in_cache, 'Distance_KM']
+                self.dist_source[in_cache[in_cache].index] = "Cache"
+
+            misses = needs_distance & (self.dist_source == "")
+            for idx, key in zip(keys.index[misses], keys.loc[misses, LANE_KEY_COLS].itertuples(index=False, name=None)):
+                self.lanes_to_fetch.setdefault(key, []).append(idx)
+
+    @property
+    def pending_index(self):
+        """Rows still waiting on a Geoapify distance."""
+        return [idx for idxs in self.lanes_to_fetch.values() for idx in idxs]
+
+    def fetch(self, idxs, budget=None):
+        """Resolves the distance for the lane shared by rows `idxs`.
+
+        Returns a new distance_cache row, or None if nothing should be cached.
+        """
+        lane = self.upload_df.loc[idxs[0]]
+        try:
+            distance_km = get_driving_distance(
+                lane['From_City'], lane['From_Country'],
+                lane['To_City'], lane['To_Country'], self.api_key,
+                budget=budget
+            )
+        except BudgetExhausted:
+            source = "Budget"
+        except ServiceUnavailable:
+            source = "Unavailable"
+        except ExternalCallFailed:
+            source = "Failed"
+        else:
+            source = "API" if distance_km else "Failed"
+        with self._lock:
+            self.dist_source[idxs] = source
+            if source == "API":
+                self.distances[idxs] = distance_km
+        if source != "API":
+            return None
+        return [
+            lane['From_Country'], lane['From_City'],
+            lane['To_Country'], lane['To_City'],
+            float(distance_km)
+        ]
+
+    def results(self, index=None):
+        """{currency: DataFrame[Price, Currency, Status, Log_Price]} for rows in `index` (default all)."""
+        index = self.keys.index if index is None else index
+        with self._lock:
+            distances = self.distances.loc[index]
+            dist_source = self.dist_source.loc[index]
+        no_api_key = pd.Series(not self.api_key, index=index)
+        results = {}
+        for cur, info in self.per_currency.items():
+            found, has_rate = info['found'].loc[index], info['has_rate'].loc[index]
+            estimated = ~found & ~no_api_key & has_rate & dist_source.isin(["Cache", "API"])
+            status = np.select(
+                [found, no_api_key, ~has_rate, dist_source == "Cache", dist_source == "API",
+                 dist_source == "Unavailable", dist_source == "Budget"],
+                ["Price Found", "Not Found (No API Key)", f"Estimation Failed (No Rate for {cur})",
+                 "Estimated (Cache)", "Estimated (API)",
+                 "Estimation Failed (Service Unavailable)", "Skipped (Batch Budget Exhausted)"],
+                default="Estimation Failed (API Error)"
+            )
+            price = info['price'].loc[index].where(found, distances * info['rate'].loc[index])
+            priced = found | estimated
+            results[cur] = pd.DataFrame({
+                'Price': price.astype(object).where(priced, "NOT FOUND"),
+                'Currency': np.where(found | (~no_api_key & has_rate), cur, "N/A"),
+                'Status': status,
+                'Log_Price': price.where(priced, 0).astype(float),
+            }, index=index)
+        return results
+
+def price_batch(upload_df, currencies, price_df, rates, dist_cache, api_key, budget=None):
+    """Prices every uploaded lane in all `currencies` in one pass.
+
+    Distances are resolved once per unique lane (cache first, then Geoapify),
+    so each extra currency only costs a merge against price_list and a
+    rate_list lookup. Once `budget` (a CallBudget) runs out, the remaining
+    uncached lanes are skipped rather than called. Returns ({currency: DataFrame[Price, Currency, Status,
+    Log_Price]}, new_distance_cache_rows), aligned to upload_df's index.
+    """
+    pricer = BatchPricer(upload_df, currencies, price_df, rates, dist_cache, api_key)
+    new_cache_entries = []
+    for idxs in pricer.lanes_to_fetch.values():
+        cache_row = pricer.fetch(idxs, budget=budget)
+        if cache_row:
+            new_cache_entries.append(cache_row)
+    return pricer.results(), new_cache_entries
+
+# --- 6b. NEAREST PRICED LANE SUGGESTIONS ---
+def _unit_xyz(lon, lat):
+    # Points on a sphere of EARTH_RADIUS_KM; Euclidean (chord) distance ~ great-circle km at lane scales
+    lon, lat = np.radians(np.asarray(lon, dtype=float)), np.radians(np.asarray(lat, dtype=float))
+    return EARTH_RADIUS_KM * np.column_stack([np.cos(lat) * np.cos(lon), np.cos(lat) * np.sin(lon), np.sin(lat)])
+
+def _haversine_km(lon1, lat1, lon2, lat2):
+    lon1, lat1, lon2, lat2 = (np.radians(np.asarray(v, dtype=float)) for v in (lon1, lat1, lon2, lat2))
+    a = np.sin((lat2 - lat1) / 2) ** 2 + np.cos(lat1) * np.cos(lat2) * np.sin((lon2 - lon1) / 2) ** 2
+    return 2 * EARTH_RADIUS_KM * np.arcsin(np.sqrt(a))
+
+LANE_COORD_COLS = ['From_Lon', 'From_Lat', 'To_Lon', 'To_Lat']
+
+def _place_key(city, country):
+    return str(city).strip().lower(), str(country).strip().lower()
+
+class PricedLaneIndex:
+    """KD-trees over geocoded price_list lanes, one per (Truck_Type, Currency).
+
+    Each lane is a 6-D point (origin xyz, destination xyz), so the tree
+    distance combines how far both the origin and the destination are
+    from the query lane. `places` maps every geocoded (city, country) to
+    (lon, lat) so query lanes are located with dict lookups, and `missing`
+    lists the priced-lane cities per (Truck_Type, Currency) still without
+    coordinates. Priced lanes are kept as column arrays so a query only
+    builds one small DataFrame.
+    """
+    def __init__(self, price_df, coords):
+        self.places = {}
+        for city, country, lon, lat in zip(coords['City'], coords['Country'], coords['Lon'], coords['Lat']):
+            if pd.notna(lon) and pd.notna(lat):
+                self.places.setdefault(_place_key(city, country), (float(lon), float(lat)))
+
+        located = price_df.assign(**dict(zip(LANE_COORD_COLS, self.locate(price_df))))
+        located = located.dropna(subset=LANE_COORD_COLS + ['Price'])
+        self.lanes = {}
+        self.trees = {}
+        for (truck, currency), group in located.groupby(['Truck_Type', 'Currency']):
+            self.lanes[(truck, currency)] = {col: group[col].to_numpy() for col in group.columns}
+            self.trees[(truck, currency)] = cKDTree(self._points(*(group[col] for col in LANE_COORD_COLS)))
+
+        self.missing = {}
+        for (truck, currency), group in price_df.groupby(['Truck_Type', 'Currency']):
+            missing = {}
+            for end in ('From', 'To'):
+                for place in zip(group[f'{end}_City'], group[f'{end}_Country']):
+                    key = _place_key(*place)
+                    if key not in self.places:
+                        missing.setdefault(key, place)
+            self.missing[(truck, currency)] = list(missing.values())
+
+    def locate(self, lanes):
+        """(From_Lon, From_Lat, To_Lon, To_Lat) arrays for `lanes`, NaN where not geocoded."""
+        located = []
+        for end in ('From', 'To'):
+            found = np.array([
+                self.places.get(_place_key(city, country), (np.nan, np.nan))
+                for city, country in zip(lanes[f'{end}_City'], lanes[f'{end}_Country'])
+            ], dtype=float).reshape(-1, 2)
+            located += [found[:, 0], found[:, 1]]
+        return located
+
+    @staticmethod
+    def _points(from_lon, from_lat, to_lon, to_lat):
+        return np.hstack([_unit_xyz(from_lon, from_lat), _unit_xyz(to_lon, to_lat)])
+
+    def query(self, query_index, located, truck, currency, k):
+        """k nearest priced lanes (same truck/currency) for lanes at `located` coordinates.
+
+        `located` is locate()'s output for those lanes and `query_index`
+        their labels, returned in the Query_Index column.
+        """
+        tree = self.trees.get((truck, currency))
+        if tree is None or not len(query_index):
+            return pd.DataFrame()
+        k = min(k, tree.n)
+        _, idx = tree.query(self._points(*located), k=k)
+        idx = np.asarray(idx).reshape(len(query_index), k).ravel()
+        matches = {col: values[idx] for col, values in self.lanes[(truck, currency)].items()}
+        from_lon, from_lat, to_lon, to_lat = (np.repeat(values, k) for values in located)
+        matches['Query_Index'] = np.repeat(np.asarray(query_index), k)
+        matches['Rank'] = np.tile(np.arange(1, k + 1), len(query_index))
+        matches['Origin_Offset_KM'] = _haversine_km(
+            from_lon, from_lat, matches['From_Lon'], matches['From_Lat']).round(1)
+        matches['Destination_Offset_KM'] = _haversine_km(
+            to_lon, to_lat, matches['To_Lon'], matches['To_Lat']).round(1)
+        return pd.DataFrame(matches)
+
+@st.cache_resource(ttl=600, max_entries=4)
+def get_priced_lane_index(_price_df, _coords, version):
+    # Keyed on `version` only: hashing both frames on every lookup costs more than the query
+    return PricedLaneIndex(_price_df, _coords)
+
+def _lane_index_version(price_df, coords):
+    # Row counts change whenever either sheet grows (e.g. new geocodes); the
+    # 600 s window (load_data's TTL) picks up in-place price_list edits
+    return len(price_df), len(coords), int(time.time() // 600)
+
+def geocode_places(places, known, api_key, budget=None):
+    """Geocodes (city, country) pairs whose lowercased key isn't in `known` via Geoapify.
+
+    Stops early if the service is unavailable or the budget runs out.
+    Returns new City/Country/Lon/Lat rows for the geocode_cache tab.
+    """
+    new_rows = []
+    if not api_key:
+        return new_rows
+    seen = set()
+    for city, country in places:
+        key = _place_key(city, country)
+        if key in known or key in seen:
+            continue
+        seen.add(key)
+        try:
+            found = call_with_breaker("geoapify", _fetch_geocode, city, country, api_key, _budget=budget)
+        except ServiceUnavailable:
+            break
+        except ExternalCallFailed:
+            continue
+        if found:
+            new_rows.append([city, country, float(found[0]), float(found[1])])
+    return new_rows
+
+def find_nearest_priced_lanes(queries, currency, price_df, coords, api_key, k=NEAREST_LANES_K, budget=None):
+    """Nearest contract-priced lanes for every row of `queries` in `currency`.
+
+    `queries` needs the lane columns plus Truck_Type. All queries are looked
+    up together, one KD-tree query per truck type. Uncached query cities are
+    geocoded first, then priced-lane cities, until `budget` runs out (pass a
+    small CallBudget on interactive paths; the rest warm up on later calls).
+    Returns (matches, new geocode_cache rows); matches has Query_Index and
+    Rank columns pointing back to `queries`.
+    """
+    if queries.empty or price_df.empty:
+        return pd.DataFrame(), []
+    index = get_priced_lane_index(price_df, coords, _lane_index_version(price_df, coords))
+    trucks = queries['Truck_Type'].astype(str).str.strip()
+    places = (list(zip(queries['From_City'], queries['From_Country']))
+              + list(zip(queries['To_City'], queries['To_Country'])))
+    for truck in trucks.unique():
+        places += index.missing.get((truck, currency), [])
+    new_rows = geocode_places(places, index.places, api_key, budget=budget)
+    if new_rows:
+        coords = pd.concat([coords, pd.DataFrame(new_rows, columns=['City', 'Country', 'Lon', 'Lat'])],
+                           ignore_index=True)
+        index = get_priced_lane_index(price_df, coords, _lane_index_version(price_df, coords))
+
+    located = index.locate(queries)
+    has_coords = ~np.isnan(np.column_stack(located)).any(axis=1)
+    truck_values = trucks.to_numpy()
+    results = []
+    for truck in trucks.unique():
+        rows = has_coords & (truck_values == truck)
+        matches = index.query(queries.index[rows], [values[rows] for values in located], truck, currency, k)
+        if not matches.empty:
+            results.append(matches)
+    if not results:
+        return pd.DataFrame(), new_rows
+    if len(results) == 1:
+        return results[0], new_rows
+    return pd.concat(results, ignore_index=True), new_rows
+
+# --- 6c. QUOTE DOCUMENT RENDERING ---
+class RenderedDocCache:
+    """LRU cache of rendered .docx bytes keyed by template + render context.
+
+    Entries live in memory up to `max_entries` / `max_bytes`; when `disk_dir`
+    is set they are also written there (up to `disk_max_bytes`, oldest first
+    out) so they survive restarts. Keys include a hash of the template file,
+    so editing the template invalidates them. Disk errors only cost a cache
+    miss; they never fail a render.
+    """
+    def __init__(self, max_entries, max_bytes, disk_dir="", disk_max_bytes=0):
+        self.max_entries = max_entries
+        self.max_bytes = max_bytes
+        self.disk_dir = disk_dir
+        self.disk_max_bytes = disk_max_bytes
+        self._entries = OrderedDict()
+        self._size = 0
+        self._template_hash = None
+        self._template_stat = None
+        self._lock = threading.Lock()
+        if disk_dir:
+            try:
+                os.makedirs(disk_dir, exist_ok=True)
+            except OSError as e:
+                st.warning(f"Quote document disk cache disabled: {e}")
+                self.disk_dir = ""
+
+    def template_hash(self, template_path):
+        # Re-hash only when the file's mtime or size changes
+        stat = os.stat(template_path)
+        stat_key = (stat.st_mtime_ns, stat.st_size)
+        with self._lock:
+            if stat_key == self._template_stat:
+                return self._template_hash
+        with open(template_path, "rb") as f:
+            new_hash = hashlib.sha256(f.read()).hexdigest()[:16]
+        with self._lock:
+            if new_hash != self._template_hash:
+                self._entries.clear()
+                self._size = 0
+                self._prune_disk(new_hash)
+            self._template_hash = new_hash
+            self._template_stat = stat_key
+        return new_hash
+
+    def _disk_files(self):
+        # [(mtime, size, path)] of cached documents, oldest first
+        files = []
+        try:
+            with os.scandir(self.disk_dir) as it:
+                for entry in it:
+                    if entry.name.endswith(".docx"):
+                        stat = entry.stat()
+                        files.append((stat.st_mtime, stat.st_size, entry.path))
+        except OSError as e:
+            st.warning(f"Failed to read quote document disk cache: {e}")
+        return sorted(files)
+
+    def _prune_disk(self, current_hash=None):
+        # Drops documents from older templates, then the oldest ones beyond disk_max_bytes
+        if not self.disk_dir:
+            return
+        files = self._disk_files()
+        stale = [f for f in files if current_hash and not os.path.basename(f[2]).startswith(current_hash)]
+        kept = [f for f in files if f not in stale]
+        size = sum(f[1] for f in kept)
+        while kept and size > self.disk_max_bytes:
+            oldest = kept.pop(0)
+            size -= oldest[1]
+            stale.append(oldest)
+        for _, _, path in stale:
+            try: os.remove(path)
+            except OSError: pass
+
+    def get(self, key):
+        with self._lock:
+            if key in self._entries:
+                self._entries.move_to_end(key)
+                return self._entries[key]
+        if self.disk_dir:
+            path = os.path.join(self.disk_dir, f"{key}.docx")
+            try:
+                with open(path, "rb") as f:
+                    data = f.read()
+                os.utime(path)  # mark as recently used for disk pruning
+            except FileNotFoundError:
+                return None
+            except OSError as e:
+                st.warning(f"Failed to read quote document disk cache: {e}")
+                return None
+            self._put_memory(key, data)
+            return data
+        return None
+
+    def put(self, key, data):
+        self._put_memory(key, data)
+        if self.disk_dir and len(data) <= self.disk_max_bytes:
+            tmp_path = os.path.join(self.disk_dir, f"{key}.tmp")
+            try:
+                with open(tmp_path, "wb") as f:
+                    f.write(data)
+                os.replace(tmp_path, os.path.join(self.disk_dir, f"{key}.docx"))
+            except OSError as e:
+                st.warning(f"Failed to write quote document disk cache: {e}")
+                try: os.remove(tmp_path)
+                except OSError: pass
+                return
+            with self._lock:
+                self._prune_disk()
+
+    def _put_memory(self, key, data):
+        if len(data) > self.max_bytes:
+            return
+        with self._lock:
+            if key in self._entries:
+                self._size -= len(self._entries.pop(key))
+            self._entries[key] = data
+            self._size += len(data)
+            while len(self._entries) > self.max_entries or self._size > self.max_bytes:
+                _, evicted = self._entries.popitem(last=False)
+                self._size -= len(evicted)
+
+@st.cache_resource
+def get_doc_cache():
+    return RenderedDocCache(DOC_CACHE_MAX_ENTRIES, DOC_CACHE_MAX_BYTES, DOC_CACHE_DIR, DOC_CACHE_DISK_MAX_BYTES)
+
+def render_quote_docx(context):
+    """Renders quote_template.docx with `context` and returns the .docx bytes.
+
+    Identical contexts against an unchanged template are served from cache.
+    """
+    doc_cache = get_doc_cache()
+    template_hash = doc_cache.template_hash(QUOTE_TEMPLATE_PATH)
+    context_hash = hashlib.sha256(
+        json.dumps(context, sort_keys=True, default=str).encode("utf-8")
+    ).hexdigest()
+    key = f"{template_hash}_{context_hash}"
+
+    data = doc_cache.get(key)
+    if data is None:
+        doc = DocxTemplate(QUOTE_TEMPLATE_PATH)
+        doc.render(context)
+        file_stream = BytesIO()
+        doc.save(file_stream)
+        data = file_stream.getvalue()
+        doc_cache.put(key, data)
+    return data
@@ -0,0 +1,435 @@
+"""Local HTTP pricing service for machine clients (TMS, CRM).
+
+Uses the same lookup and estimation logic as the Streamlit app (pricing.py),
+so prices, statuses, caches and logging match what reps see in the UI.
+
+Endpoints:
+    GET  /health
+    POST /quote   JSON lane -> JSON prices per currency, plus nearest priced lanes
+    POST /batch   many lanes -> NDJSON, one line per lane as soon as it's resolved
+
+Lanes use the same fields as the batch Excel upload:
+    {"From_Country": "UAE", "From_City": "Dubai", "To_Country": "KSA",
+     "To_City": "Riyadh", "Truck_Type": "Flatbed - 3 Axle 13.6M"}
+
+/quote body:  {...lane fields..., "currencies": ["AED", "SAR"], "prepared_by": "tms"}
+/batch body:  {"currencies": ["AED"], "prepared_by": "tms", "lanes": [{...}, ...]}
+              or NDJSON (Content-Type: application/x-ndjson), one lane per line,
+              with ?currencies=AED,SAR&prepared_by=tms in the query string.
+
+Run standalone (reads .streamlit/secrets.toml like the app):
+    python pricing_api.py --host 127.0.0.1 --port 8502
+or set `pricing_api_port` in secrets to start it inside the Streamlit process,
+where it shares the app's warm caches. If `pricing_api_token` is set, clients
+must send "Authorization: Bearer <token>". Log rows and new cache entries are
+buffered and written to the sheets in the background every
+`pricing_api_flush_seconds` (default 5).
+"""
+import argparse
+import atexit
+import datetime
+import hmac
+import json
+import math
+import threading
+import time
+from concurrent.futures import ThreadPoolExecutor, as_completed
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from urllib.parse import parse_qs, urlparse
+
+import pandas as pd
+import streamlit as st
+
+from pricing import (
+    LANE_KEY_COLS, NEAREST_LANES_K, NEAREST_GEOCODE_MAX_CALLS, NEAREST_GEOCODE_MAX_SECONDS,
+    BatchPricer, CallBudget,
+    get_gspread_client, load_data, load_rates, load_distance_cache, load_geocode_cache,
+    get_log_sheet, log_requests, save_rows_to_distance_cache, save_to_geocode_cache,
+    find_nearest_priced_lanes
+)
+
+REQUIRED_LANE_FIELDS = LANE_KEY_COLS + ['Truck_Type']
+API_MAX_WORKERS = int(st.secrets.get("pricing_api_workers", 8))
+API_MAX_BODY_BYTES = int(st.secrets.get("pricing_api_max_body_mb", 20)) * 1024 * 1024
+API_FLUSH_SECONDS = float(st.secrets.get("pricing_api_flush_seconds", 5))
+API_SOCKET_TIMEOUT = float(st.secrets.get("pricing_api_socket_timeout_seconds", 30))
+
+
+class BadRequest(Exception):
+    """Client error, reported back as HTTP 400."""
+
+
+# --- PRICING ---
+def _reference_data():
+    # All st.cache_data-backed, so these are warm after the first request
+    client = get_gspread_client()
+    return {
+        'client': client,
+        'prices': load_data(client),
+        'rates': load_rates(client),
+        'distance_cache': load_distance_cache(client),
+        'geocode_cache': load_geocode_cache(client),
+    }
+
+def _json_number(value):
+    try:
+        value = float(value)
+    except (TypeError, ValueError):
+        return None
+    return None if math.isnan(value) else value
+
+def _lane_records(lanes_df, results, index):
+    records = []
+    for idx in index:
+        record = {'index': int(idx)}
+        record.update({col: lanes_df.at[idx, col] for col in REQUIRED_LANE_FIELDS})
+        record['prices'] = {
+            cur: {
+                'price': _json_number(res.at[idx, 'Price']),
+                'currency': res.at[idx, 'Currency'],
+                'status': res.at[idx, 'Status'],
+            }
+            for cur, res in results.items()
+        }
+        records.append(record)
+    return records
+
+def _log_rows(lanes_df, results, prepared_by):
+    timestamp = datetime.datetime.now().strftime("%Y-%m-%d %H:%M:%S")
+    rows = []
+    for cur, res in results.items():
+        for row, status, price, currency in zip(
+            lanes_df[REQUIRED_LANE_FIELDS].itertuples(index=False),
+            res['Status'], res['Log_Price'], res['Currency']
+        ):
+            rows.append([
+                timestamp, "API", prepared_by,
+                "", "", "", "", "",
+                row.From_Country, row.From_City, row.To_Country, row.To_City,
+                row.Truck_Type, status, float(price), currency
+            ])
+    return rows
+
+class SheetWriter:
+    """Write-behind buffer for the API's request_log, distance_cache and geocode_cache rows.
+
+    Requests only append here; a background thread writes whatever has
+    gathered every `interval` seconds, one append per tab. That keeps Sheets
+    write quota and latency off the request path, and new distances are
+    saved without clearing the distance cache every session shares.
+    """
+    def __init__(self, client, interval):
+        self.client = client
+        self.interval = interval
+        self._rows = {'log': [], 'distance': [], 'geocode': []}
+        self._lock = threading.Lock()
+        self._flush_lock = threading.Lock()
+        threading.Thread(target=self._run, name="pricing-api-writer", daemon=True).start()
+
+    def add(self, log_rows=(), distance_rows=(), geocode_rows=()):
+        with self._lock:
+            self._rows['log'].extend(log_rows)
+            self._rows['distance'].extend(distance_rows)
+            self._rows['geocode'].extend(geocode_rows)
+
+    @staticmethod
+    def _unique(rows, key_len):
+        # Concurrent requests for the same lane/city each resolve it; keep one row per key
+        unique = {}
+        for row in rows:
+            unique.setdefault(tuple(str(v).strip().lower() for v in row[:key_len]), row)
+        return list(unique.values())
+
+    def flush(self):
+        with self._flush_lock:
+            with self._lock:
+                rows, self._rows = self._rows, {'log': [], 'distance': [], 'geocode': []}
+            if rows['distance']:
+                save_rows_to_distance_cache(self.client, self._unique(rows['distance'], 4), refresh=False)
+            if rows['geocode']:
+                save_to_geocode_cache(self.client, self._unique(rows['geocode'], 2))
+            if rows['log']:
+                log_sheet = get_log_sheet(self.client, datetime.date.today().strftime("%Y_%m"))
+                log_requests(log_sheet, rows['log'])
+
+    def _run(self):
+        while True:
+            time.sleep(self.interval)
+            try:
+                self.flush()
+            except Exception as e:
+                st.warning(f"Pricing API failed to write buffered rows: {e}")
+
+@st.cache_resource
+def get_sheet_writer():
+    writer = SheetWriter(get_gspread_client(), API_FLUSH_SECONDS)
+    atexit.register(writer.flush)
+    return writer
+
+@st.cache_resource
+def get_fetch_pool():
+    # One pool for every /batch in the process, so concurrent batches share pricing_api_workers
+    return ThreadPoolExecutor(max_workers=API_MAX_WORKERS, thread_name_prefix="pricing-api-fetch")
+
+def _finish(lanes_df, pricer, new_cache_entries, prepared_by, index=None):
+    # Queues log rows for the lanes in `index` (default all) and any new distances
+    index = lanes_df.index if index is None else index
+    get_sheet_writer().add(
+        log_rows=_log_rows(lanes_df.loc[index], pricer.results(index), prepared_by),
+        distance_rows=new_cache_entries
+    )
+
+def _lanes_frame(lanes):
+    if not isinstance(lanes, list) or not lanes:
+        raise BadRequest("Expected a non-empty list of lanes.")
+    if not all(isinstance(lane, dict) for lane in lanes):
+        raise BadRequest("Each lane must be a JSON object.")
+    lanes_df = pd.DataFrame(lanes)
+    missing = [col for col in REQUIRED_LANE_FIELDS if col not in lanes_df.columns]
+    if missing:
+        raise BadRequest(f"Lanes are missing required fields: {missing}")
+    values = lanes_df[REQUIRED_LANE_FIELDS]
+    blank = values.isna() | values.apply(lambda col: col.astype(str).str.strip() == "")
+    if blank.any(axis=None):
+        bad = [int(idx) for idx in lanes_df.index[blank.any(axis=1)][:10]]
+        raise BadRequest(f"Lanes {bad} have null or empty required fields ({REQUIRED_LANE_FIELDS}).")
+    lanes_df[REQUIRED_LANE_FIELDS] = values.astype(str)
+    return lanes_df
+
+def _currencies(value, rates):
+    if isinstance(value, str):
+        value = [c.strip() for c in value.split(",") if c.strip()]
+    if not value:
+        raise BadRequest("At least one currency is required.")
+    if not isinstance(value, list) or not all(isinstance(c, str) for c in value):
+        raise BadRequest("Currencies must be a string or a list of strings.")
+    known = set(rates['Currency']) if 'Currency' in rates.columns else set()
+    unknown = [c for c in value if c not in known]
+    if unknown:
+        raise BadRequest(f"Unknown currencies {unknown}; rate_list has {sorted(known)}.")
+    return list(dict.fromkeys(value))
+
+def quote_lane(payload):
+    """Prices one lane in every requested currency, with nearest priced lanes for misses."""
+    if not isinstance(payload, dict):
+        raise BadRequest("Expected a JSON object.")
+    try:
+        k = int(payload.get('nearest', NEAREST_LANES_K))
+    except (TypeError, ValueError):
+        raise BadRequest("'nearest' must be an integer.")
+    data = _reference_data()
+    lanes_df = _lanes_frame([{col: payload.get(col) for col in REQUIRED_LANE_FIELDS if col in payload}])
+    currencies = _currencies(payload.get('currencies') or payload.get('currency'), data['rates'])
+    api_key = st.secrets.get("geoapify_api_key")
+
+    pricer = BatchPricer(lanes_df, currencies, data['prices'], data['rates'], data['distance_cache'], api_key)
+    new_cache_entries = [
+        row for row in (pricer.fetch(idxs) for idxs in pricer.lanes_to_fetch.values()) if row
+    ]
+    results = pricer.results()
+    record = _lane_records(lanes_df, results, lanes_df.index)[0]
+
+    geocode_cache = data['geocode_cache']
+    geocode_budget = CallBudget(NEAREST_GEOCODE_MAX_CALLS, NEAREST_GEOCODE_MAX_SECONDS)
+    for cur, res in results.items():
+        if k <= 0 or res.at[0, 'Status'] == "Price Found":
+            continue
+        nearest, new_geocodes = find_nearest_priced_lanes(
+            lanes_df, cur, data['prices'], geocode_cache, api_key, k=k, budget=geocode_budget
+        )
+        if new_geocodes:
+            get_sheet_writer().add(geocode_rows=new_geocodes)
+            geocode_cache = pd.concat([geocode_cache, pd.DataFrame(new_geocodes, columns=['City', 'Country', 'Lon', 'Lat'])],
+                                      ignore_index=True)
+        record['prices'][cur]['nearest_priced_lanes'] = [
+            {
+                'From_City': lane.From_City, 'From_Country': lane.From_Country,
+                'To_City': lane.To_City, 'To_Country': lane.To_Country,
+                'price': _json_number(lane.Price),
+                'origin_offset_km': _json_number(lane.Origin_Offset_KM),
+                'destination_offset_km': _json_number(lane.Destination_Offset_KM),
+            }
+            for lane in nearest.itertuples(index=False)
+        ] if not nearest.empty else []
+
+    _finish(lanes_df, pricer, new_cache_entries, payload.get('prepared_by') or "API")
+    return record
+
+def stream_batch(lanes, currencies, prepared_by):
+    """Yields one result record per lane as soon as it is resolved, then a summary record.
+
+    Exact prices and cached distances come out first; uncached lanes are
+    fetched on the shared fetch pool (bounded by a CallBudget) and stream as
+    they finish. If the client goes away, the lanes priced so far are still
+    logged and their distances saved.
+    """
+    data = _reference_data()
+    lanes_df = _lanes_frame(lanes)
+    currencies = _currencies(currencies, data['rates'])
+    api_key = st.secrets.get("geoapify_api_key")
+
+    pricer = BatchPricer(lanes_df, currencies, data['prices'], data['rates'], data['distance_cache'], api_key)
+    pending = set(pricer.pending_index)
+    ready = [idx for idx in lanes_df.index if idx not in pending]
+    yield from _lane_records(lanes_df, pricer.results(ready), ready)
+
+    budget = CallBudget()
+    new_cache_entries = []
+    completed = list(ready)
+    pool = get_fetch_pool()
+    futures = {pool.submit(pricer.fetch, idxs, budget): idxs for idxs in pricer.lanes_to_fetch.values()}
+    try:
+        for future in as_completed(futures):
+            cache_row = future.result()
+            if cache_row:
+                new_cache_entries.append(cache_row)
+            idxs = futures[future]
+            completed += idxs
+            yield from _lane_records(lanes_df, pricer.results(idxs), idxs)
+    finally:
+        # Runs on normal completion and when the client disconnects mid-stream
+        for future in futures:
+            future.cancel()
+        _finish(lanes_df, pricer, new_cache_entries, prepared_by, completed)
+
+    statuses = pd.concat([res['Status'] for res in pricer.results().values()])
+    yield {
+        'summary': {
+            'lanes': len(lanes_df),
+            'currencies': currencies,
+            'api_calls': budget.calls,
+            'budget_exhausted': budget.exhausted,
+            'statuses': statuses.value_counts().to_dict(),
+        }
+    }
+
+
+# --- HTTP ---
+class PricingRequestHandler(BaseHTTPRequestHandler):
+    server_version = "TruKKerPricing/1.0"
+    timeout = API_SOCKET_TIMEOUT  # applied to the connection socket, so stalled clients don't hold a thread
+
+    def _authorized(self):
+        token = st.secrets.get("pricing_api_token")
+        if not token:
+            return True
+        given = self.headers.get("Authorization", "")
+        return hmac.compare_digest(given.encode("utf-8"), f"Bearer {token}".encode("utf-8"))
+
+    def _send_json(self, status, body):
+        payload = json.dumps(body, default=str).encode("utf-8")
+        self.send_response(status)
+        self.send_header("Content-Type", "application/json")
+        self.send_header("Content-Length", str(len(payload)))
+        self.end_headers()
+        self.wfile.write(payload)
+
+    def _write_line(self, record):
+        self.wfile.write((json.dumps(record, default=str) + "\n").encode("utf-8"))
+        self.wfile.flush()
+
+    def _read_body(self):
+        try:
+            length = int(self.headers.get("Content-Length") or 0)
+        except ValueError:
+            raise BadRequest("Content-Length must be an integer.")
+        if length < 0:
+            raise BadRequest("Content-Length must not be negative.")
+        if length > API_MAX_BODY_BYTES:
+            raise BadRequest(f"Request body larger than {API_MAX_BODY_BYTES} bytes.")
+        try:
+            return self.rfile.read(length).decode("utf-8")
+        except TimeoutError:
+            raise BadRequest("Timed out reading the request body.")
+        except UnicodeDecodeError:
+            raise BadRequest("Request body must be UTF-8.")
+
+    def _parse_batch(self, query):
+        body = self._read_body()
+        content_type = self.headers.get("Content-Type", "")
+        try:
+            if "ndjson" in content_type:
+                lanes = [json.loads(line) for line in body.splitlines() if line.strip()]
+                return lanes, query.get('currencies', [""])[0], query.get('prepared_by', ["API"])[0]
+            payload = json.loads(body or "{}")
+        except json.JSONDecodeError as e:
+            raise BadRequest(f"Invalid JSON: {e}")
+        if not isinstance(payload, dict):
+            raise BadRequest("Expected a JSON object.")
+        return payload.get('lanes'), payload.get('currencies') or payload.get('currency'), payload.get('prepared_by') or "API"
+
+    def do_GET(self):
+        if urlparse(self.path).path == "/health":
+            self._send_json(200, {'status': "ok"})
+        else:
+            self._send_json(404, {'error': "Not found"})
+
+    def do_POST(self):
+        url = urlparse(self.path)
+        if not self._authorized():
+            self._send_json(401, {'error': "Unauthorized"})
+            return
+        try:
+            if url.path == "/quote":
+                try:
+                    payload = json.loads(self._read_body() or "{}")
+                except json.JSONDecodeError as e:
+                    raise BadRequest(f"Invalid JSON: {e}")
+                self._send_json(200, quote_lane(payload))
+            elif url.path == "/batch":
+                lanes, currencies, prepared_by = self._parse_batch(parse_qs(url.query))
+                records = stream_batch(lanes, currencies, prepared_by)
+                first = next(records)  # surfaces validation errors before headers are sent
+                self.send_response(200)
+                self.send_header("Content-Type", "application/x-ndjson")
+                self.end_headers()
+                try:
+                    self._write_line(first)
+                    for record in records:
+                        self._write_line(record)
+                except (BrokenPipeError, ConnectionResetError):
+                    records.close()
+                except Exception as e:
+                    # The 200 status is already out, so report the failure in-band and end the stream
+                    records.close()
+                    try:
+                        self._write_line({'error': f"Pricing failed: {e}"})
+                    except OSError:
+                        pass
+                    self.close_connection = True
+            else:
+                self._send_json(404, {'error': "Not found"})
+        except BadRequest as e:
+            self._send_json(400, {'error': str(e)})
+        except Exception as e:
+            self._send_json(500, {'error': f"Pricing failed: {e}"})
+
+
+def make_server(host="127.0.0.1", port=8502):
+    server = ThreadingHTTPServer((host, port), PricingRequestHandler)
+    server.daemon_threads = True
+    return server
+
+@st.cache_resource
+def start_in_background(host, port):
+    """Starts the service on a daemon thread, once per process (used by app.py)."""
+    server = make_server(host, port)
+    threading.Thread(target=server.serve_forever, name="pricing-api", daemon=True).start()
+    return server
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description="TruKKer local pricing API")
+    parser.add_argument("--host", default=st.secrets.get("pricing_api_host", "127.0.0.1"))
+    parser.add_argument("--port", type=int, default=int(st.secrets.get("pricing_api_port", 8502)))
+    args = parser.parse_args(argv)
+    server = make_server(args.host, args.port)
+    print(f"Pricing API listening on http://{args.host}:{args.port}")
+    try:
+        server.serve_forever()
+    except KeyboardInterrupt:
+        pass
+    finally:
+        server.server_close()
+
+if __name__ == "__main__":
+    main()